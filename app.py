@@ -1,8 +1,28 @@
 import streamlit as st
-import requests
+from streamlit.errors import StreamlitAPIException
+import httpx
+import tiktoken
+import pandas as pd
+import plotly.express as px
+import asyncio
+import contextlib
 import time
 import json
 import random
+import functools
+import os
+import hashlib
+import sqlite3
+import threading
+import queue
+import unicodedata
+import bisect
+import uuid
+import sys
+from enum import Enum
+from email.utils import parsedate_to_datetime
+from concurrent.futures import as_completed, TimeoutError as FuturesTimeoutError
+from collections import OrderedDict, deque
 from datetime import datetime
 
 # 页面配置
@@ -13,6 +33,121 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# 模型探测配置
+PROBE_TIMEOUT_SECONDS = 10     # 单个模型探测超时
+PROBE_DEADLINE_SECONDS = 15    # 全部模型探测的总截止时间
+
+# 模型服务与HTTP连接池配置
+MODEL_API_URL = os.getenv('MODEL_API_URL', "https://models.inference.ai.azure.com/chat/completions")
+HTTP_POOL_MAXSIZE = int(os.getenv('MODEL_HTTP_POOL_MAXSIZE', '256'))         # 同时保持的最大连接数
+HTTP2_ENABLED = os.getenv('MODEL_HTTP2', '0') == '1'                         # 需要安装 httpx[http2]
+
+# 后端池配置：MODEL_BACKENDS 为JSON数组或JSON文件路径，每项包含 name、base_url（或完整 url）、
+# 可选的 api_key / api_key_env 和 models 列表；未配置时只使用 MODEL_API_URL 和用户填写的密钥
+MODEL_BACKENDS = os.getenv('MODEL_BACKENDS', '')
+BACKEND_FAILURE_THRESHOLD = 3                 # 连续失败多少次后暂停向该后端发请求
+BACKEND_COOLDOWN_SECONDS = 30                 # 暂停多久后允许重新尝试
+BACKEND_HEALTH_INTERVAL_SECONDS = 15          # 后台健康检查间隔
+BACKEND_HEALTH_TIMEOUT_SECONDS = 5            # 健康检查超时
+
+# 滚动摘要配置
+SUMMARY_MODEL = os.getenv('MODEL_SUMMARY_MODEL', 'gpt-4o-mini')   # 生成摘要使用的低成本模型
+SUMMARY_TRIGGER_TOKENS = 3000                 # 未摘要的较早消息超过该token数时触发压缩
+SUMMARY_KEEP_RECENT_MESSAGES = 6              # 最近的若干条消息始终保留原文
+SUMMARY_BATCH_MESSAGES = 200                  # 一轮压缩最多并入的消息数
+SUMMARY_MAX_TOKENS = 600                      # 摘要长度上限
+SUMMARY_MESSAGE_CHARS = 2000                  # 并入摘要时每条消息最多保留的字符数
+
+# 上下文构建配置
+DEFAULT_TEMPERATURE = 0.7
+MAX_COMPLETION_TOKENS = 2000                                                # 为模型回复预留的token数
+MAX_PROMPT_TOKENS = int(os.getenv('MODEL_MAX_PROMPT_TOKENS', '8000'))       # 服务端单次请求的输入上限
+TOKENS_PER_MESSAGE = 4                                                      # 每条消息的格式开销
+CONTEXT_SAFETY_MARGIN = 64                                                  # token估算误差余量
+
+# 本地数据目录（跨会话、跨进程共享）
+DATA_DIR = os.getenv('APP_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.data')
+
+# 模型可用性缓存配置
+AVAILABILITY_DB_PATH = os.path.join(DATA_DIR, 'model_availability.sqlite3')
+AVAILABILITY_TTL_SECONDS = 30 * 60            # 缓存有效期
+AVAILABILITY_REFRESH_AHEAD_SECONDS = 5 * 60   # 过期前多久开始后台刷新
+AVAILABILITY_REFRESH_INTERVAL_SECONDS = 60    # 后台刷新线程的检查间隔
+AVAILABILITY_MAX_ENTRIES = 256                # 最多缓存的密钥数量
+AVAILABILITY_TIMEOUT_TTL_SECONDS = 60         # 含探测超时的结果只缓存这么久，之后重新探测
+
+# 响应缓存配置（需在侧边栏开启）
+RESPONSE_CACHE_DB_PATH = os.path.join(DATA_DIR, 'response_cache.sqlite3')
+RESPONSE_CACHE_TTL_SECONDS = 24 * 3600        # 缓存回复的有效期
+RESPONSE_CACHE_MEMORY_ENTRIES = 512           # 内存LRU容量
+RESPONSE_CACHE_DISK_ENTRIES = 10000           # 磁盘缓存容量
+
+# 智能路由配置
+AUTO_MODEL_ID = 'auto'
+ROUTING_TIERS = {                             # 各档位的候选模型（按偏好排序）
+    '快速': ['gpt-4o-mini', 'llama-3.1-8b-instruct', 'qwen-2.5-7b-instruct', 'claude-3-haiku', 'mistral-small'],
+    '推荐': ['gpt-4o-mini', 'gpt-4o', 'claude-3-5-sonnet', 'qwen-2.5-72b-instruct', 'llama-3.1-70b-instruct'],
+    '高质量': ['gpt-4o', 'claude-3-5-sonnet', 'llama-3.1-405b-instruct', 'gpt-4-turbo', 'mistral-large-2407'],
+}
+ROUTING_WINDOW_SIZE = 50                      # 每个模型保留的最近调用样本数
+ROUTING_WINDOW_SECONDS = 10 * 60              # 只统计最近这段时间内的样本
+ROUTING_MAX_ERROR_RATE = 0.2                  # 错误率超过此值的模型不参与路由
+ROUTING_DEFAULT_LATENCY = 3.0                 # 没有样本时假定的延迟（秒）
+
+# 重试与熔断配置
+RETRY_MAX_ATTEMPTS = 3                        # 单次对话最多尝试次数（含首次）
+RETRY_BASE_DELAY_SECONDS = 0.5                # 指数退避的基础间隔
+RETRY_MAX_DELAY_SECONDS = 8                   # 单次等待的上限（含 Retry-After）
+RETRY_BUDGET_SECONDS = 20                     # 所有重试等待的总预算
+BREAKER_FAILURE_THRESHOLD = 5                 # 连续失败多少次后熔断
+BREAKER_RECOVERY_SECONDS = 30                 # 熔断多久后放行一次试探请求
+
+# 请求对冲配置
+HEDGE_MIN_SAMPLES = 10                        # 至少有这么多样本才根据 p95 计算对冲时机
+HEDGE_MIN_DELAY_SECONDS = 0.5                 # 对冲等待时间下限
+HEDGE_MAX_DELAY_SECONDS = 10                  # 对冲等待时间上限
+HEDGE_FALLBACK_MODELS = {                     # 对冲请求发往的备用模型，未配置时发往同一模型
+    'llama-3.1-405b-instruct': 'llama-3.1-70b-instruct',
+    'qwen-2.5-72b-instruct': 'qwen-2.5-32b-instruct',
+    'mistral-large-2407': 'mistral-small',
+}
+
+# 调用遥测配置
+TELEMETRY_BUFFER_SIZE = 2000                                     # 内存中保留的最近调用记录数
+TELEMETRY_JSONL_PATH = os.getenv('MODEL_TELEMETRY_JSONL', '')    # 非空时把每次调用追加写入该JSONL文件
+
+# 限流配置（按各后端实际使用的API密钥和模型分别计数，跨进程共享）
+RATE_LIMIT_DB_PATH = os.path.join(DATA_DIR, 'rate_limits.sqlite3')
+RATE_LIMIT_REQUESTS_PER_MINUTE = int(os.getenv('MODEL_RATE_LIMIT_RPM', '15'))       # 每分钟请求数
+RATE_LIMIT_TOKENS_PER_MINUTE = int(os.getenv('MODEL_RATE_LIMIT_TPM', '40000'))      # 每分钟 token 数
+RATE_LIMIT_MAX_WAIT_SECONDS = 60              # 排队等待超过该时间时直接提示稍后再试
+PROBE_TOKEN_COST = 10                         # 一次探测请求大约消耗的 token 数
+
+# 防重复提交配置
+SUBMIT_TOKEN_HISTORY = 100                    # 每个会话记住的已使用提交令牌数量
+
+# 相似问题缓存配置（MinHash + LSH分桶）
+NEAR_DUP_NGRAM = 2                            # 字符n-gram长度（中文以2字为宜）
+NEAR_DUP_NUM_PERM = 64                        # MinHash签名长度
+NEAR_DUP_BANDS = 16                           # LSH分桶数（每桶 64/16=4 行）
+NEAR_DUP_THRESHOLD = 0.8                      # 默认相似度阈值
+NEAR_DUP_MAX_ENTRIES = 2000                   # 最多索引的问答条数
+NEAR_DUP_CONTEXT_MESSAGES = 2                 # 参与比较的最近上下文消息数
+NEAR_DUP_CONTEXT_CHARS = 1000                 # 上下文参与比较的最大字符数
+
+# 服务端会话存储配置
+SESSION_DB_PATH = os.path.join(DATA_DIR, 'chat_sessions.sqlite3')
+MESSAGE_PAGE_SIZE = 50                        # 打开会话时每页加载的消息数
+GUEST_ID_PARAM = 'uid'                        # 未登录时保存访客ID的地址栏参数
+SESSION_VIEW_CACHE_SIZE = 20                  # 保留已加载消息窗口的服务端会话数，切换回来时无需重新读取
+
+# 对话渲染配置
+RENDER_WINDOW_MESSAGES = 20                   # 默认只渲染最近的消息条数（约10轮）
+RENDER_PAGE_MESSAGES = 20                     # 每次“加载更早的消息”多展开的条数
+MESSAGE_HTML_CACHE_SIZE = 500                 # 每个会话缓存的消息HTML数量
+SESSION_PAGE_SIZE = 10                        # 历史会话面板每页显示的会话数
+STATS_REFRESH_SECONDS = 10                    # 使用统计片段的自动刷新间隔
+
 def apply_styles():
     """应用样式和本地存储JavaScript"""
     st.markdown("""
@@ -293,12 +428,39 @@ def initialize_session_state():
         'available_models': [],
         'selected_model': 'gpt-4o-mini',
         'models_loaded': False,
+        'model_probe_results': {},
+        'model_availability_updated_at': 0,
+        'force_model_probe': False,
         'conversation_count': 0,
         'auto_save_enabled': True,
+        'stream_enabled': True,
+        'routing_tier': '推荐',
+        'last_route': None,
+        'response_cache_enabled': False,
+        'hedging_enabled': False,
+        'submit_token': None,
+        'accepted_submit': None,
+        'used_submit_tokens': deque(maxlen=SUBMIT_TOKEN_HISTORY),
+        'duplicate_submits': 0,
+        'near_dup_cache_enabled': False,
+        'near_dup_threshold': NEAR_DUP_THRESHOLD,
+        'last_response_metrics': None,
         'chat_sessions': {},
         'current_session_id': None,
         'session_counter': 0,
-        'restore_checked': False
+        'restore_checked': False,
+        'chat_data_dirty': False,
+        'persisted_chat_state': None,
+        'session_store_owner': None,
+        'current_session_created': None,
+        'earlier_messages_cursor': None,
+        'pending_export_session': None,
+        'render_window': RENDER_WINDOW_MESSAGES,
+        'message_html_cache': OrderedDict(),
+        'session_views': OrderedDict(),
+        'session_index': SessionIndex(),
+        'session_page': 0,
+        'latency_summary': None
     }
     
     for key, value in defaults.items():
@@ -316,10 +478,11 @@ def check_for_saved_data():
         with restore_placeholder:
             st.markdown("""
             <script>
+            """ + CHAT_LOG_REPLAY_JS + """
             // 检查本地存储
             function checkLocalStorage() {
                 try {
-                    const completeData = localStorage.getItem('ai_chat_complete_data');
+                    const completeData = loadChatData();
                     const oldData = localStorage.getItem('ai_chat_data');
                     
                     let messageCount = 0;
@@ -548,158 +711,1551 @@ def try_apply_js_data():
             # 这里应该有恢复逻辑，但由于Streamlit限制，暂时使用占位符
             pass
 
-def save_chat_data():
-    """保存聊天数据到本地存储"""
-    if st.session_state.get('auto_save_enabled', True):
-        # 准备数据
-        save_data = {
-            'current_messages': st.session_state.chat_messages,
-            'current_session_id': st.session_state.get('current_session_id'),
-            'sessions': {},
-            'session_counter': st.session_state.get('session_counter', 0),
-            'api_key': st.session_state.github_api_key,
-            'selected_model': st.session_state.selected_model,
-            'conversation_count': st.session_state.conversation_count,
-            'save_timestamp': time.time()
+class MessageRole(str, Enum):
+    """消息角色，继承 str 以便与字符串直接比较和序列化"""
+    USER = 'user'
+    ASSISTANT = 'assistant'
+    SYSTEM = 'system'
+
+MESSAGE_ROLES = {role.value: role for role in MessageRole}
+
+class ChatMessage:
+    """会话中的一条消息
+
+    用 __slots__ 代替字典以节省内存；角色使用枚举单例，模型名驻留（intern）后由所有消息共享。
+    支持 msg['content']、msg.get('model') 这类字典式访问，to_dict / from_dict 与导出的JSON格式互相无损转换。
+    """
+    __slots__ = ('id', 'role', 'content', 'model', 'timestamp', 'token_cache', 'extra')
+    FIELDS = ('id', 'role', 'content', 'model', 'timestamp')
+
+    def __init__(self, role, content, timestamp=None, model=None, id=None, extra=None):
+        self.id = id
+        self.role = MESSAGE_ROLES.get(role, role)
+        self.content = content
+        self.model = sys.intern(model) if isinstance(model, str) else model
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.token_cache = None      # (编码名, token数)，只缓存最近使用的一种编码
+        self.extra = extra           # 导入数据中无法识别的字段，原样保留
+
+    @classmethod
+    def from_dict(cls, data):
+        """从导出格式的字典构建消息"""
+        extra = {key: value for key, value in data.items() if key not in cls.FIELDS and key != 'token_counts'}
+        return cls(data['role'], data['content'], data.get('timestamp'), data.get('model'),
+                   data.get('id'), extra or None)
+
+    def to_dict(self):
+        """转换为导出格式的字典，未设置的字段不输出"""
+        role = self.role.value if isinstance(self.role, MessageRole) else self.role
+        data = {'role': role, 'content': self.content, 'timestamp': self.timestamp}
+        if self.model is not None:
+            data['model'] = self.model
+        if self.id is not None:
+            data['id'] = self.id
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            if self.extra and key in self.extra:
+                return self.extra[key]
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            value = self.extra.get(key) if self.extra else None
+        return default if value is None else value
+
+    def __eq__(self, other):
+        if not isinstance(other, ChatMessage):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"ChatMessage({self.to_dict()!r})"
+
+def json_default(value):
+    """json.dumps 的兜底转换：消息转为导出格式，其余转为字符串"""
+    if isinstance(value, ChatMessage):
+        return value.to_dict()
+    return str(value)
+
+# 本地存储键与增量日志配置
+PERSIST_SNAPSHOT_KEY = 'ai_chat_complete_data'
+PERSIST_LOG_KEY = 'ai_chat_log'
+PERSIST_COMPACT_EVERY = 200    # 增量日志累计多少条记录后合并为完整快照
+
+# 在浏览器端将 快照 + 增量日志 重放为完整数据（与 ai_chat_complete_data 格式相同）
+CHAT_LOG_REPLAY_JS = """
+function loadChatData() {
+    const snapshot = localStorage.getItem('ai_chat_complete_data');
+    const log = localStorage.getItem('ai_chat_log');
+    if (!log) {
+        return snapshot;
+    }
+
+    const data = snapshot ? JSON.parse(snapshot) : {};
+    data.current_messages = data.current_messages || [];
+    data.sessions = data.sessions || {};
+
+    for (const line of log.split('\\n')) {
+        if (!line) continue;
+        const record = JSON.parse(line);
+        switch (record.op) {
+            case 'meta':
+                Object.assign(data, record.meta);
+                break;
+            case 'append':
+                data.current_messages.push(...record.messages);
+                break;
+            case 'set_current':
+                data.current_messages = record.messages;
+                break;
+            case 'load_session':
+                data.current_messages = data.sessions[record.sid] ? data.sessions[record.sid].messages.slice() : [];
+                break;
+            case 'session_put':
+                data.sessions[record.sid] = record.session;
+                break;
+            case 'session_append':
+                if (data.sessions[record.sid]) {
+                    data.sessions[record.sid].messages.push(...record.messages);
+                    Object.assign(data.sessions[record.sid], record.info);
+                }
+                break;
+            case 'session_delete':
+                delete data.sessions[record.sid];
+                break;
         }
-        
-        # 处理sessions数据
-        for session_id, session_info in st.session_state.get('chat_sessions', {}).items():
-            save_data['sessions'][session_id] = {
-                'messages': session_info['messages'],
-                'created_time': session_info['created_time'].isoformat() if hasattr(session_info['created_time'], 'isoformat') else str(session_info['created_time']),
-                'message_count': session_info['message_count'],
-                'title': session_info['title']
-            }
-        
-        # 保存到localStorage
+    }
+    return JSON.stringify(data);
+}
+"""
+
+def save_chat_data(force=False):
+    """标记聊天数据需要保存，实际写入在本次运行结束时由 flush_chat_data 合并完成"""
+    if force or st.session_state.get('auto_save_enabled', True):
+        st.session_state.chat_data_dirty = True
+
+def format_created_time(created_time):
+    """将会话创建时间转换为可序列化的字符串"""
+    return created_time.isoformat() if hasattr(created_time, 'isoformat') else str(created_time)
+
+def get_messages_fingerprint(messages):
+    """消息列表指纹：(条数, 最后一条的时间戳)，用于判断是否只是追加"""
+    if not messages:
+        return (0, None)
+    return (len(messages), messages[-1].get('timestamp'))
+
+def is_appended(messages, fingerprint):
+    """判断消息列表是否是在已保存指纹的基础上追加而来"""
+    count, last_timestamp = fingerprint
+    if len(messages) < count:
+        return False
+    return count == 0 or messages[count - 1].get('timestamp') == last_timestamp
+
+def get_persist_meta():
+    """需要保存的会话级元数据"""
+    return {
+        'current_session_id': st.session_state.get('current_session_id'),
+        'session_counter': st.session_state.get('session_counter', 0),
+        'api_key': st.session_state.github_api_key,
+        'selected_model': st.session_state.selected_model,
+        'conversation_count': st.session_state.conversation_count,
+    }
+
+def get_session_info(session_info):
+    """会话元数据（不含消息）"""
+    return {
+        'created_time': format_created_time(session_info['created_time']),
+        'message_count': session_info['message_count'],
+        'title': session_info['title']
+    }
+
+def build_chat_snapshot():
+    """构建完整快照（原 ai_chat_complete_data 格式）"""
+    save_data = get_persist_meta()
+    save_data['current_messages'] = st.session_state.chat_messages
+    save_data['save_timestamp'] = time.time()
+    save_data['sessions'] = {}
+
+    for session_id, session_info in st.session_state.get('chat_sessions', {}).items():
+        # 未加载消息的会话以服务端存储为准
+        if session_info['messages'] is None:
+            continue
+        save_data['sessions'][session_id] = dict(get_session_info(session_info),
+                                                 messages=session_info['messages'])
+    return save_data
+
+def build_chat_delta(persisted):
+    """对比已保存状态，生成只包含新增或变更内容的日志记录"""
+    records = []
+
+    meta = get_persist_meta()
+    if meta != persisted['meta']:
+        records.append({'op': 'meta', 'meta': meta})
+
+    # 当前对话
+    messages = st.session_state.chat_messages
+    current_id = st.session_state.get('current_session_id')
+    current = persisted['current']
+    sessions = st.session_state.get('chat_sessions', {})
+    if current['session_id'] == current_id and is_appended(messages, current['fingerprint']):
+        if len(messages) > current['fingerprint'][0]:
+            records.append({'op': 'append', 'messages': messages[current['fingerprint'][0]:]})
+    elif (current_id in sessions and current_id in persisted['sessions']
+          and sessions[current_id]['messages'] is not None
+          and get_messages_fingerprint(sessions[current_id]['messages']) == get_messages_fingerprint(messages)
+          and persisted['sessions'][current_id]['fingerprint'] == get_messages_fingerprint(messages)):
+        # 切换到已保存的会话，无需重新写入消息
+        records.append({'op': 'load_session', 'sid': current_id})
+    else:
+        records.append({'op': 'set_current', 'messages': messages})
+
+    # 历史会话
+    for session_id, session_info in sessions.items():
+        if session_info['messages'] is None:
+            continue
+        saved = persisted['sessions'].get(session_id)
+        info = get_session_info(session_info)
+        session_messages = session_info['messages']
+        if saved and is_appended(session_messages, saved['fingerprint']):
+            new_messages = session_messages[saved['fingerprint'][0]:]
+            if new_messages or info != saved['info']:
+                records.append({'op': 'session_append', 'sid': session_id,
+                                'messages': new_messages, 'info': info})
+        else:
+            records.append({'op': 'session_put', 'sid': session_id,
+                            'session': dict(info, messages=session_messages)})
+
+    for session_id in persisted['sessions']:
+        if session_id not in sessions:
+            records.append({'op': 'session_delete', 'sid': session_id})
+
+    return records
+
+def snapshot_persisted_state(log_records, previous=None):
+    """记录当前已保存的状态，供下次计算增量"""
+    sessions = {}
+    for session_id, session_info in st.session_state.get('chat_sessions', {}).items():
+        if session_info['messages'] is None:
+            # 未加载的会话沿用上次保存的状态
+            if previous and session_id in previous['sessions']:
+                sessions[session_id] = previous['sessions'][session_id]
+            continue
+        sessions[session_id] = {
+            'fingerprint': get_messages_fingerprint(session_info['messages']),
+            'info': get_session_info(session_info),
+        }
+
+    return {
+        'meta': get_persist_meta(),
+        'current': {
+            'session_id': st.session_state.get('current_session_id'),
+            'fingerprint': get_messages_fingerprint(st.session_state.chat_messages),
+        },
+        'sessions': sessions,
+        'log_records': log_records,
+    }
+
+def flush_chat_data():
+    """把本次运行中累积的变更一次性写入本地存储
+
+    平时只追加增量日志；首次保存或日志过长时写入完整快照并清空日志。
+    """
+    if not st.session_state.get('chat_data_dirty'):
+        return
+    st.session_state.chat_data_dirty = False
+
+    persisted = st.session_state.get('persisted_chat_state')
+    records = build_chat_delta(persisted) if persisted else None
+
+    if records is not None and persisted['log_records'] + len(records) <= PERSIST_COMPACT_EVERY:
+        if not records:
+            return
+        log_lines = "".join(json.dumps(record, default=json_default, ensure_ascii=False) + "\n" for record in records)
         st.markdown(f"""
         <script>
         try {{
-            const data = {json.dumps(save_data, default=str)};
-            localStorage.setItem('ai_chat_complete_data', JSON.stringify(data));
-            console.log('💾 数据已保存 - 消息数:', data.current_messages.length);
+            const lines = {json.dumps(log_lines)};
+            localStorage.setItem('{PERSIST_LOG_KEY}', (localStorage.getItem('{PERSIST_LOG_KEY}') || '') + lines);
+            console.log('💾 增量保存 - 记录数:', {len(records)});
         }} catch (error) {{
             console.error('❌ 保存失败:', error);
         }}
         </script>
         """, unsafe_allow_html=True)
+        st.session_state.persisted_chat_state = snapshot_persisted_state(persisted['log_records'] + len(records), persisted)
+        return
+
+    # 写入完整快照并压缩日志
+    save_data = build_chat_snapshot()
+    st.markdown(f"""
+    <script>
+    try {{
+        const data = {json.dumps(save_data, default=json_default)};
+        localStorage.setItem('{PERSIST_SNAPSHOT_KEY}', JSON.stringify(data));
+        localStorage.removeItem('{PERSIST_LOG_KEY}');
+        console.log('💾 数据已保存 - 消息数:', data.current_messages.length);
+    }} catch (error) {{
+        console.error('❌ 保存失败:', error);
+    }}
+    </script>
+    """, unsafe_allow_html=True)
+    st.session_state.persisted_chat_state = snapshot_persisted_state(0)
+
+def open_session_db():
+    """打开服务端会话数据库（WAL模式，支持多进程并发读写）"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(SESSION_DB_PATH, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            title TEXT NOT NULL,
+            created_time REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_owner ON sessions (owner, created_time);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            model TEXT,
+            timestamp REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, timestamp);
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """)
+    return conn
+
+def get_user_identity():
+    """当前用户的标识：配置了登录时使用登录账号，否则使用保存在页面地址中的随机访客ID
+
+    同一个API密钥可能由整个团队共用，不能用密钥区分用户。
+    """
+    # st.user 从 Streamlit 1.42 开始提供，更早的版本只有 st.experimental_user
+    user = getattr(st, 'user', None) or getattr(st, 'experimental_user', None)
+    if user is not None and user.get('is_logged_in'):
+        return f"user:{user.get('sub') or user.get('email')}"
+
+    guest_id = st.session_state.get('guest_id')
+    if not guest_id:
+        try:
+            guest_id = uuid.UUID(hex=st.query_params.get(GUEST_ID_PARAM, '')).hex
+        except ValueError:
+            guest_id = uuid.uuid4().hex
+            st.query_params[GUEST_ID_PARAM] = guest_id
+        st.session_state.guest_id = guest_id
+    return f"guest:{guest_id}"
+
+def make_session_owner(api_key, identity):
+    """会话归属键：用户标识与API密钥共同决定，只保存哈希"""
+    return hashlib.sha256(f"{identity}\n{api_key}".encode('utf-8')).hexdigest()
+
+def get_session_owner():
+    """会话归属：区分用户和API密钥，未配置密钥时不使用服务端存储"""
+    api_key = st.session_state.github_api_key
+    return make_session_owner(api_key, get_user_identity()) if api_key else None
+
+def store_list_sessions(owner):
+    """只读取会话元数据，不加载消息"""
+    conn = open_session_db()
+    try:
+        rows = conn.execute(
+            "SELECT session_id, title, created_time, message_count FROM sessions "
+            "WHERE owner = ? ORDER BY created_time DESC",
+            (owner,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return rows
+
+def store_append_messages(owner, session_id, messages, title, created_time):
+    """追加消息并更新会话元数据，写入后为每条消息记录数据库ID"""
+    conn = open_session_db()
+    try:
+        with conn:
+            # 标题只在会话还没有标题时写入；会话属于其他用户时不更新，整个事务回滚
+            cursor = conn.execute(
+                """INSERT INTO sessions (session_id, owner, title, created_time, message_count, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(session_id) DO UPDATE SET
+                       message_count = sessions.message_count + excluded.message_count,
+                       title = CASE WHEN sessions.title = '新对话' THEN excluded.title ELSE sessions.title END,
+                       updated_at = excluded.updated_at
+                   WHERE sessions.owner = excluded.owner""",
+                (session_id, owner, title, created_time.timestamp(), len(messages), time.time())
+            )
+            if cursor.rowcount != 1:
+                raise PermissionError(f"会话 {session_id} 不属于当前用户")
+            for msg in messages:
+                cursor = conn.execute(
+                    "INSERT INTO messages (session_id, role, content, model, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, msg['role'], msg['content'], msg.get('model'), msg.get('timestamp', time.time()))
+                )
+                msg['id'] = cursor.lastrowid
+    finally:
+        conn.close()
+
+def store_load_messages(owner, session_id, before_id=None, limit=MESSAGE_PAGE_SIZE):
+    """按页加载会话消息（从新到旧），返回 (消息列表, 是否还有更早的消息)"""
+    conn = open_session_db()
+    try:
+        rows = conn.execute(
+            "SELECT m.id, m.role, m.content, m.model, m.timestamp FROM messages m "
+            "JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND s.owner = ? AND m.id < ? ORDER BY m.id DESC LIMIT ?",
+            (session_id, owner, before_id if before_id is not None else 2 ** 63 - 1, limit + 1)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    has_more = len(rows) > limit
+    messages = [
+        ChatMessage(row[1], row[2], row[4], row[3], row[0])
+        for row in reversed(rows[:limit])
+    ]
+    return messages, has_more
+
+def store_count_user_messages(owner, session_id):
+    """统计会话中的用户消息数（即对话轮数）"""
+    conn = open_session_db()
+    try:
+        return conn.execute(
+            "SELECT COUNT(*) FROM messages m JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND s.owner = ? AND m.role = 'user'",
+            (session_id, owner)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+def store_owned_sessions(conn, owner, session_ids):
+    """筛选出属于 owner 的会话ID"""
+    return [sid for sid in session_ids
+            if conn.execute("SELECT 1 FROM sessions WHERE session_id = ? AND owner = ?", (sid, owner)).fetchone()]
+
+def store_clear_messages(owner, session_id):
+    """清空会话中的消息，保留会话本身"""
+    conn = open_session_db()
+    try:
+        with conn:
+            if not store_owned_sessions(conn, owner, [session_id]):
+                return
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
+            conn.execute("UPDATE sessions SET message_count = 0, title = '新对话' WHERE session_id = ? AND owner = ?",
+                         (session_id, owner))
+    finally:
+        conn.close()
+
+def store_delete_sessions(owner, session_ids):
+    """删除会话及其消息（只删除属于 owner 的会话）"""
+    conn = open_session_db()
+    try:
+        with conn:
+            params = [(sid,) for sid in store_owned_sessions(conn, owner, session_ids)]
+            conn.executemany("DELETE FROM messages WHERE session_id = ?", params)
+            conn.executemany("DELETE FROM session_summaries WHERE session_id = ?", params)
+            conn.executemany("DELETE FROM sessions WHERE session_id = ?", params)
+    finally:
+        conn.close()
+
+def store_load_messages_after(owner, session_id, after_id, limit):
+    """按时间顺序加载ID大于 after_id 的消息"""
+    conn = open_session_db()
+    try:
+        rows = conn.execute(
+            "SELECT m.id, m.role, m.content FROM messages m JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND s.owner = ? AND m.id > ? ORDER BY m.id LIMIT ?",
+            (session_id, owner, after_id, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [{'id': row[0], 'role': row[1], 'content': row[2]} for row in rows]
+
+def store_get_summary(owner, session_id):
+    """读取会话的滚动摘要，返回 {'text', 'covered_id'}，没有时返回 None"""
+    conn = open_session_db()
+    try:
+        row = conn.execute(
+            "SELECT m.summary, m.covered_id FROM session_summaries m JOIN sessions s ON s.session_id = m.session_id "
+            "WHERE m.session_id = ? AND s.owner = ?", (session_id, owner)
+        ).fetchone()
+    finally:
+        conn.close()
+    return {'text': row[0], 'covered_id': row[1]} if row else None
+
+def store_save_summary(session_id, summary, covered_id, previous_covered_id):
+    """仅当摘要仍停留在 previous_covered_id（None 表示还没有摘要）时写入，返回是否写入
+
+    多个进程同时压缩同一会话时，只有先完成的一方生效，另一方的结果被丢弃。
+    """
+    conn = open_session_db()
+    try:
+        with conn:
+            if previous_covered_id is None:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO session_summaries (session_id, summary, covered_id, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (session_id, summary, covered_id, time.time())
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE session_summaries SET summary = ?, covered_id = ?, updated_at = ? "
+                    "WHERE session_id = ? AND covered_id = ?",
+                    (summary, covered_id, time.time(), session_id, previous_covered_id)
+                )
+            return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+def session_meta_from_row(row):
+    """将数据库行转换为 chat_sessions 中的会话条目（消息按需加载，用户消息数在首次打开时统计）"""
+    return {
+        'messages': None,
+        'created_time': datetime.fromtimestamp(row[2]),
+        'message_count': row[3],
+        'title': row[1],
+        'user_count': None
+    }
+
+class SessionIndex:
+    """按创建时间排序的会话索引，增删时用二分查找维持顺序，渲染历史面板时无需重新排序"""
+
+    def __init__(self, sessions=None):
+        self._key_of = {
+            session_id: (entry['created_time'].timestamp(), session_id)
+            for session_id, entry in (sessions or {}).items()
+        }
+        self._keys = sorted(self._key_of.values())    # (创建时间戳, 会话ID)，升序
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, session_id, created_time):
+        if session_id in self._key_of:
+            return
+        key = (created_time.timestamp(), session_id)
+        self._key_of[session_id] = key
+        bisect.insort(self._keys, key)
+
+    def remove(self, session_id):
+        key = self._key_of.pop(session_id, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def page(self, offset, limit, match=None):
+        """从新到旧跳过 offset 个会话后取 limit 个，返回 (会话ID列表, 后面是否还有)
+
+        传入 match 时只计入 match(会话ID) 为真的会话，扫描到凑满一页为止。
+        """
+        if match is None:
+            end = max(len(self._keys) - offset, 0)
+            start = max(end - limit, 0)
+            return [key[1] for key in reversed(self._keys[start:end])], start > 0
+
+        page_ids = []
+        for key in reversed(self._keys):
+            if not match(key[1]):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            if len(page_ids) == limit:
+                return page_ids, True
+            page_ids.append(key[1])
+        return page_ids, False
+
+def new_session_entry():
+    """为当前对话创建会话条目
+
+    内存中的会话直接引用对话区的消息列表，两者是同一个只追加的列表；
+    服务端存储的会话不保存消息，已加载的消息窗口放在 session_views 中。
+    """
+    return {
+        'messages': None if get_session_owner() else st.session_state.chat_messages,
+        'created_time': st.session_state.get('current_session_created') or datetime.now(),
+        'message_count': 0,
+        'title': "新对话",
+        'user_count': 0
+    }
+
+def load_session_index():
+    """用户或密钥变化时从服务端存储加载其会话列表（仅元数据），并关闭之前打开的对话"""
+    owner = get_session_owner()
+    if owner == st.session_state.session_store_owner:
+        return
+    previous_owner = st.session_state.session_store_owner
+    st.session_state.session_store_owner = owner
+    st.session_state.session_views.clear()
+    if previous_owner:
+        st.session_state.current_session_id = None
+        st.session_state.current_session_created = None
+        st.session_state.chat_messages = []
+        st.session_state.earlier_messages_cursor = None
+        st.session_state.render_window = RENDER_WINDOW_MESSAGES
+        st.session_state.conversation_count = 0
+    if owner:
+        st.session_state.chat_sessions = {row[0]: session_meta_from_row(row) for row in store_list_sessions(owner)}
+    elif previous_owner:
+        st.session_state.chat_sessions = {}
+    st.session_state.session_index = SessionIndex(st.session_state.chat_sessions)
+    st.session_state.session_page = 0
+
+def ensure_current_session():
+    """确保当前对话有会话ID，返回该ID"""
+    if not st.session_state.current_session_id:
+        st.session_state.session_counter += 1
+        st.session_state.current_session_id = uuid.uuid4().hex
+        st.session_state.current_session_created = datetime.now()
+    return st.session_state.current_session_id
+
+def record_new_messages(new_messages):
+    """登记本轮新增的消息：增量更新会话条目的标题和计数，并写入服务端存储
+
+    返回会话列表是否需要刷新（新建了会话或标题发生变化）。
+    """
+    session_id = ensure_current_session()
+    entry = st.session_state.chat_sessions.get(session_id)
+    list_changed = entry is None
+    if entry is None:
+        entry = st.session_state.chat_sessions[session_id] = new_session_entry()
+        st.session_state.session_index.add(session_id, entry['created_time'])
+    entry['message_count'] += len(new_messages)
+    if entry['user_count'] is not None:
+        entry['user_count'] += sum(1 for msg in new_messages if msg['role'] == 'user')
+    if entry['title'] == "新对话":
+        entry['title'] = get_session_title(new_messages)
+        list_changed = True
+
+    owner = get_session_owner()
+    if owner:
+        store_append_messages(owner, session_id, new_messages, entry['title'], entry['created_time'])
+        get_summarizer().schedule(owner, session_id, st.session_state.github_api_key)
+    return list_changed
+
+def load_earlier_messages():
+    """加载当前会话更早的一页消息"""
+    cursor = st.session_state.earlier_messages_cursor
+    if cursor is None or not st.session_state.current_session_id:
+        return
+    page, has_more = store_load_messages(get_session_owner(), st.session_state.current_session_id, before_id=cursor)
+    st.session_state.chat_messages = page + st.session_state.chat_messages
+    st.session_state.earlier_messages_cursor = page[0]['id'] if has_more and page else None
+
+def stash_current_session():
+    """离开当前会话前记下对话区的消息窗口（只保存引用，不复制消息）"""
+    session_id = st.session_state.current_session_id
+    entry = st.session_state.chat_sessions.get(session_id) if session_id else None
+    if entry is None or entry['messages'] is not None:
+        # 内存中的会话与对话区共享同一个列表，无需处理
+        return
+
+    views = st.session_state.session_views
+    views[session_id] = (st.session_state.chat_messages, st.session_state.earlier_messages_cursor)
+    views.move_to_end(session_id)
+    if len(views) > SESSION_VIEW_CACHE_SIZE:
+        views.popitem(last=False)
+
+def reset_session_entry(session_id):
+    """会话消息被清空后重置其条目，对话区换用新的空列表"""
+    st.session_state.chat_messages = []
+    st.session_state.session_views.pop(session_id, None)
+    entry = st.session_state.chat_sessions.get(session_id)
+    if entry is not None:
+        entry.update(new_session_entry(), created_time=entry['created_time'])
+
+def open_session(session_id):
+    """切换到指定会话：只切换列表引用；服务端存储的会话首次打开时加载最近一页消息"""
+    stash_current_session()
+
+    entry = st.session_state.chat_sessions[session_id]
+    st.session_state.current_session_id = session_id
+    st.session_state.render_window = RENDER_WINDOW_MESSAGES
+    st.session_state.current_session_created = entry['created_time']
+    if entry['messages'] is not None:
+        messages, cursor = entry['messages'], None
+    else:
+        view = st.session_state.session_views.pop(session_id, None)
+        if view is None:
+            messages, has_more = store_load_messages(get_session_owner(), session_id)
+            view = (messages, messages[0]['id'] if has_more and messages else None)
+        messages, cursor = view
+        if entry['user_count'] is None:
+            entry['user_count'] = store_count_user_messages(get_session_owner(), session_id)
+    st.session_state.chat_messages = messages
+    st.session_state.earlier_messages_cursor = cursor
+    st.session_state.conversation_count = entry['user_count']
+
+def load_full_session_messages(session_id):
+    """导出时读取会话的全部消息"""
+    session_data = st.session_state.chat_sessions[session_id]
+    if session_data['messages'] is not None:
+        return session_data['messages']
+    messages, _ = store_load_messages(get_session_owner(), session_id, limit=max(session_data['message_count'], 1))
+    return messages
 
 def get_all_supported_models():
     """获取所有支持的AI模型"""
     return [
+        {
+            'id': AUTO_MODEL_ID,
+            'name': '智能路由',
+            'description': '根据各模型最近的响应延迟和错误率，自动选择当前最合适的模型',
+            'context_window': 128000,
+            'tags': ['自动', '推荐']
+        },
         {
             'id': 'gpt-4o',
             'name': 'GPT-4o',
             'description': 'OpenAI最新的GPT-4 Omni模型，具备强大的多模态能力和理解力',
+            'context_window': 128000,
             'tags': ['多模态', '最新', '高质量']
         },
         {
             'id': 'gpt-4o-mini',
             'name': 'GPT-4o Mini',
             'description': '轻量化版本的GPT-4o，响应速度快，成本更低，适合日常对话',
+            'context_window': 128000,
             'tags': ['快速', '经济', '推荐']
         },
         {
             'id': 'gpt-4-turbo',
             'name': 'GPT-4 Turbo',
             'description': 'OpenAI的增强版GPT-4，支持更长的上下文，处理能力强',
+            'context_window': 128000,
             'tags': ['长上下文', '稳定', '强大']
         },
         {
             'id': 'gpt-3.5-turbo',
             'name': 'GPT-3.5 Turbo',
             'description': 'OpenAI的经典模型，在性能和成本之间取得良好平衡',
+            'context_window': 16385,
             'tags': ['经典', '平衡', '可靠']
         },
         {
             'id': 'claude-3-5-sonnet',
             'name': 'Claude 3.5 Sonnet',
             'description': 'Anthropic最新的Claude模型，擅长分析、推理和创作',
+            'context_window': 200000,
             'tags': ['分析', '推理', '创作']
         },
         {
             'id': 'claude-3-haiku',
             'name': 'Claude 3 Haiku',
             'description': 'Claude系列中速度最快的模型，适合快速响应',
+            'context_window': 200000,
             'tags': ['快速', 'Anthropic', '轻量']
         },
         {
             'id': 'llama-3.1-405b-instruct',
             'name': 'Llama 3.1 405B',
             'description': 'Meta最大规模的开源模型，在推理和数学方面表现优异',
+            'context_window': 128000,
             'tags': ['开源', '大模型', '推理']
         },
         {
             'id': 'llama-3.1-70b-instruct',
             'name': 'Llama 3.1 70B',
             'description': 'Meta的中等规模模型，平衡了性能和效率',
+            'context_window': 128000,
             'tags': ['开源', '平衡', 'Meta']
         },
         {
             'id': 'llama-3.1-8b-instruct',
             'name': 'Llama 3.1 8B',
             'description': 'Meta的轻量级模型，响应速度极快',
+            'context_window': 128000,
             'tags': ['开源', '轻量', '快速']
         },
         {
             'id': 'qwen-2.5-72b-instruct',
             'name': 'Qwen 2.5 72B',
             'description': '阿里巴巴通义千问最新模型，中文理解能力强',
+            'context_window': 32768,
             'tags': ['中文优化', '阿里巴巴', '最新']
         },
         {
             'id': 'qwen-2.5-32b-instruct',
             'name': 'Qwen 2.5 32B',
             'description': '通义千问中等规模模型，中英文双语能力出色',
+            'context_window': 32768,
             'tags': ['中文', '双语', '通义']
         },
         {
             'id': 'qwen-2.5-7b-instruct',
             'name': 'Qwen 2.5 7B',
             'description': '通义千问轻量级模型，适合快速中文对话',
+            'context_window': 32768,
             'tags': ['中文', '轻量', '快速']
         },
         {
             'id': 'mistral-large-2407',
             'name': 'Mistral Large',
             'description': 'Mistral AI的大型模型，多语言能力强',
+            'context_window': 128000,
             'tags': ['多语言', 'Mistral', '欧洲']
         },
         {
             'id': 'mistral-small',
             'name': 'Mistral Small',
             'description': 'Mistral AI的轻量级模型，成本效益高',
+            'context_window': 32000,
             'tags': ['轻量', '经济', 'Mistral']
         }
     ]
 
-def test_model_availability(api_key, model_id):
-    """测试模型可用性"""
-    if not api_key:
-        return False
-        
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    
+class CallTelemetry:
+    """记录每次模型调用的耗时、token数和状态：内存中为定长环形缓冲，可选追加写入JSONL"""
+
+    def __init__(self, capacity=TELEMETRY_BUFFER_SIZE, jsonl_path=TELEMETRY_JSONL_PATH):
+        self._records = deque(maxlen=capacity)
+        self._jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self.sequence = 0
+        self._pending = None
+        if jsonl_path:
+            # 记录多在共享事件循环上产生，文件追加交给后台线程，不阻塞其他请求
+            self._pending = queue.Queue()
+            threading.Thread(target=self._write_jsonl, name="telemetry-writer", daemon=True).start()
+
+    def record(self, **fields):
+        record = dict(fields, timestamp=time.time())
+        with self._lock:
+            self._records.append(record)
+            self.sequence += 1
+        if self._pending is not None:
+            self._pending.put(record)
+
+    def _write_jsonl(self):
+        while True:
+            records = [self._pending.get()]
+            # 积压的记录一次写入
+            while not self._pending.empty():
+                records.append(self._pending.get_nowait())
+            try:
+                with open(self._jsonl_path, 'a', encoding='utf-8') as f:
+                    f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            except OSError:
+                pass
+
+    def snapshot(self):
+        """返回当前缓冲区中的全部记录"""
+        with self._lock:
+            return list(self._records)
+
+def load_backend_config(raw=MODEL_BACKENDS):
+    """读取后端池配置，返回后端参数列表；未配置时只有一个使用用户密钥的默认后端"""
+    if not raw:
+        return [{'name': 'default', 'url': MODEL_API_URL, 'api_key': None, 'models': None}]
+    if os.path.isfile(raw):
+        with open(raw, encoding='utf-8') as f:
+            raw = f.read()
+
+    backends = []
+    for index, entry in enumerate(json.loads(raw)):
+        url = entry.get('url') or entry['base_url'].rstrip('/') + '/chat/completions'
+        api_key = entry.get('api_key')
+        if not api_key and entry.get('api_key_env'):
+            api_key = os.getenv(entry['api_key_env'])
+        backends.append({
+            'name': entry.get('name') or f"backend-{index + 1}",
+            'url': url,
+            'api_key': api_key,
+            'models': set(entry['models']) if entry.get('models') else None,
+        })
+    return backends
+
+class ModelBackend:
+    """后端池中的一个服务地址，记录在途请求数和连续失败情况"""
+
+    def __init__(self, name, url, api_key=None, models=None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.models = models
+        self.outstanding = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def serves(self, model_id):
+        return self.models is None or model_id in self.models
+
+    def healthy(self, now):
+        return now >= self.cooldown_until
+
+    @property
+    def health_url(self):
+        return self.url.rsplit('/chat/completions', 1)[0] + '/models'
+
+class BackendPool:
+    """多后端负载均衡：优先选择在途请求最少的健康后端，失败时切换到下一个"""
+
+    def __init__(self, backends, failure_threshold=BACKEND_FAILURE_THRESHOLD,
+                 cooldown=BACKEND_COOLDOWN_SECONDS):
+        self._backends = [ModelBackend(**backend) for backend in backends]
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def candidates(self, model_id):
+        """按尝试顺序返回可服务该模型的后端：健康的按在途请求数升序，冷却中的排在最后兜底"""
+        now = time.monotonic()
+        with self._lock:
+            serving = [b for b in self._backends if b.serves(model_id)]
+            healthy = [b for b in serving if b.healthy(now)]
+            cooling = [b for b in serving if not b.healthy(now)]
+            random.shuffle(healthy)
+            healthy.sort(key=lambda b: b.outstanding)
+            cooling.sort(key=lambda b: b.cooldown_until)
+        return healthy + cooling
+
+    @staticmethod
+    def api_key_for(backend, user_api_key):
+        """后端配置了自己的密钥时使用它，否则使用用户填写的密钥"""
+        return backend.api_key or user_api_key
+
+    @contextlib.contextmanager
+    def track(self, backend):
+        """统计发往该后端的在途请求"""
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+        try:
+            yield backend
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+
+    def record_success(self, backend):
+        with self._lock:
+            backend.failures = 0
+            backend.cooldown_until = 0.0
+
+    def record_failure(self, backend):
+        with self._lock:
+            backend.failures += 1
+            backend.errors += 1
+            if backend.failures >= self._failure_threshold:
+                backend.cooldown_until = time.monotonic() + self._cooldown
+
+    async def run_health_checks(self, client, interval=BACKEND_HEALTH_INTERVAL_SECONDS):
+        """后台定期检查冷却中的后端，能正常响应（非5xx）即恢复"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                cooling = [b for b in self._backends if not b.healthy(now)]
+            for backend in cooling:
+                try:
+                    status_code = await client.get_status(backend.health_url, BACKEND_HEALTH_TIMEOUT_SECONDS)
+                except Exception:
+                    continue
+                if status_code < 500:
+                    self.record_success(backend)
+
+    def snapshot(self):
+        """返回各后端的名称、在途请求、请求与错误次数和健康状态"""
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'name': b.name,
+                'outstanding': b.outstanding,
+                'requests': b.requests,
+                'errors': b.errors,
+                'healthy': b.healthy(now),
+            } for b in self._backends]
+
+class AsyncModelClient:
+    """进程级共享的异步HTTP客户端：在后台事件循环上复用连接，探测和对话请求共用同一个循环"""
+
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, http2=HTTP2_ENABLED, limiter=None):
+        self._lock = threading.Lock()
+        self._requests_sent = 0
+        self._connections = 0
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self.telemetry = CallTelemetry()
+        self.backends = BackendPool(load_backend_config())
+        # 选定后端后按该后端的密钥预约限流额度；为 None 时不限流
+        self.limiter = limiter
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="model-client-loop", daemon=True)
+        self._thread.start()
+
+        limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+        try:
+            self._client = httpx.AsyncClient(http2=http2, limits=limits)
+            self._http2 = http2
+        except ImportError:
+            # 未安装 h2 时退回 HTTP/1.1
+            self._client = httpx.AsyncClient(limits=limits)
+            self._http2 = False
+        self.submit(self.backends.run_health_checks(self))
+
+    @property
+    def http2(self):
+        return self._http2
+
+    async def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._connections += 1
+
+    def submit(self, coro):
+        """把协程提交到后台事件循环，返回可在任意线程等待或取消的 Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, headers, json, timeout, timings=None):
+        """发送POST请求，响应以流式方式读取，离开上下文时释放连接
+
+        传入 timings 字典时写入本次请求的建连耗时 connect_time 和首字节延迟 ttfb（秒）。
+        """
+        with self._lock:
+            self._requests_sent += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        start = time.perf_counter()
+
+        async def trace(event_name, info):
+            await self._trace(event_name, info)
+            if timings is None:
+                return
+            if event_name == "connection.connect_tcp.started":
+                timings['connect_started'] = time.perf_counter()
+            elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                timings['connect_time'] = time.perf_counter() - timings.get('connect_started', start)
+            elif event_name.endswith("receive_response_headers.complete"):
+                timings['ttfb'] = time.perf_counter() - start
+
+        try:
+            async with self._client.stream("POST", url, headers=headers, json=json, timeout=timeout,
+                                           extensions={"trace": trace}) as response:
+                yield response
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    async def get_status(self, url, timeout):
+        """发送GET请求并返回状态码，用于健康检查"""
+        response = await self._client.get(url, timeout=timeout)
+        return response.status_code
+
+    def stats(self):
+        """返回请求数、新建连接数、复用次数和在途请求数"""
+        with self._lock:
+            return {
+                'requests': self._requests_sent,
+                'connections': self._connections,
+                'reused': max(0, self._requests_sent - self._connections),
+                'in_flight': self._in_flight,
+                'peak_in_flight': self._peak_in_flight,
+                'http2': self.http2,
+            }
+
+@st.cache_resource
+def get_http_client():
+    """获取进程级共享的HTTP客户端（跨重跑和会话复用）"""
+    return AsyncModelClient(limiter=get_rate_limiter())
+
+class SingleFlight:
+    """按请求指纹合并并发的相同调用：同一时间只发出一次，其余调用等待并共享结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """在调用线程中执行 fn；已有相同调用在途时等待它的结果。返回 (结果, 是否共享)"""
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = {'done': threading.Event(), 'result': None,
+                                               'error': None, 'interrupted': True}
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                break
+            call['done'].wait()
+            if call['interrupted']:
+                # 发起方的脚本运行被中断（如页面重跑），由等待者自己重新发起
+                continue
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = fn()
+            call['interrupted'] = False
+        except Exception as e:
+            call['error'] = e
+            call['interrupted'] = False
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result'], False
+
+    def share(self, key, start):
+        """返回 key 对应的在途 Future；没有时调用 start() 发起并登记"""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._futures[key] = start()
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+@st.cache_resource
+def get_single_flight():
+    """获取进程级共享的请求合并表（跨会话生效）"""
+    return SingleFlight()
+
+class RateLimiter:
+    """跨进程共享的令牌桶限流器：按API密钥和模型分别限制请求数和 token 数
+
+    配置了多个后端时按各后端实际使用的密钥计数，每个密钥有自己的额度。
+
+    桶的水位保存在SQLite中，每次预约在一个写事务里完成。水位允许变为负数，
+    表示已经排在后面的请求，新的预约据此算出需要等待的时间，相当于跨进程的先来先服务队列。
+    """
+
+    def __init__(self, db_path=RATE_LIMIT_DB_PATH, requests_per_minute=RATE_LIMIT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE, max_wait=RATE_LIMIT_MAX_WAIT_SECONDS):
+        self._db_path = db_path
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self.reservations = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def _open_db(self):
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+        conn = sqlite3.connect(self._db_path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                bucket_key TEXT PRIMARY KEY,
+                level REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        return conn
+
+    def _buckets(self, api_key, model_id, tokens):
+        key_hash = hash_api_key(api_key)
+        return [
+            (f"requests:{key_hash}:{model_id}", 1, self._requests_per_minute),
+            # 单次请求超过桶容量时按容量计，避免永远等不到
+            (f"tokens:{key_hash}:{model_id}", min(tokens, self._tokens_per_minute), self._tokens_per_minute),
+        ]
+
+    def reserve(self, api_key, model_id, tokens, max_wait=None):
+        """预约一次请求，返回需要等待的秒数；需要等待超过 max_wait 时不预约并返回 None"""
+        index, wait = self.reserve_any([api_key], model_id, tokens, max_wait)
+        return None if index is None else wait
+
+    def _levels(self, conn, api_key, model_id, tokens, now):
+        """计算预约后各个桶的水位，返回 (水位列表, 需要等待的秒数)"""
+        wait = 0.0
+        levels = []
+        for bucket_key, cost, capacity in self._buckets(api_key, model_id, tokens):
+            row = conn.execute(
+                "SELECT level, updated_at FROM rate_buckets WHERE bucket_key = ?", (bucket_key,)
+            ).fetchone()
+            rate = capacity / 60
+            level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            level -= cost
+            if level < 0:
+                wait = max(wait, -level / rate)
+            levels.append((bucket_key, level, now))
+        return levels, wait
+
+    def reserve_any(self, api_keys, model_id, tokens, max_wait=None):
+        """在几个密钥中选择需要等待最短的一个预约，等待相同时按给出的顺序，返回 (下标, 等待秒数)
+
+        所有密钥都需要等待超过 max_wait 时不预约并返回 (None, None)。
+        """
+        max_wait = self._max_wait if max_wait is None else max_wait
+        now = time.time()
+        try:
+            conn = self._open_db()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                options = [self._levels(conn, api_key, model_id, tokens, now) for api_key in api_keys]
+                index = min(range(len(options)), key=lambda i: options[i][1])
+                levels, wait = options[index]
+                if wait > max_wait:
+                    conn.execute("ROLLBACK")
+                    with self._lock:
+                        self.rejected += 1
+                    return None, None
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rate_buckets (bucket_key, level, updated_at) VALUES (?, ?, ?)",
+                    levels
+                )
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # 限流状态不可用时不阻塞请求，由服务端的429和重试兜底
+            return 0, 0.0
+
+        with self._lock:
+            self.reservations += 1
+            if wait > 0:
+                self.queued += 1
+                self.total_wait += wait
+        return index, wait
+
+    def refund(self, api_key, model_id, tokens, requests=0):
+        """归还预约时多扣的 token；请求最终没有发出时同时归还 requests 次请求额度"""
+        amounts = [requests, max(tokens, 0)]
+        refunds = [(capacity, amount, bucket_key)
+                   for (bucket_key, _, capacity), amount in zip(self._buckets(api_key, model_id, tokens), amounts)
+                   if amount > 0]
+        if not refunds:
+            return
+        try:
+            conn = self._open_db()
+            try:
+                with conn:
+                    conn.executemany(
+                        "UPDATE rate_buckets SET level = MIN(?, level + ?) WHERE bucket_key = ?", refunds
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """返回预约次数、排队次数、平均等待和拒绝次数"""
+        with self._lock:
+            return {
+                'reservations': self.reservations,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'avg_wait': self.total_wait / self.queued if self.queued else 0.0,
+            }
+
+@st.cache_resource
+def get_rate_limiter():
+    """获取进程级的限流器（水位在进程间通过SQLite共享）"""
+    return RateLimiter()
+
+async def reserve_backend(client, backends, api_key, model_id, tokens, max_wait=None):
+    """按各后端实际使用的密钥预约限流额度，选出需要等待最短的后端，返回 (后端, 等待秒数)
+
+    所有后端都需要等待超过 max_wait 时不预约并返回 (None, None)。
+    """
+    if client.limiter is None:
+        return backends[0], 0.0
+    api_keys = [client.backends.api_key_for(backend, api_key) for backend in backends]
+    index, wait = await asyncio.to_thread(client.limiter.reserve_any, api_keys, model_id, tokens, max_wait)
+    return (None, None) if index is None else (backends[index], wait)
+
+async def refund_backend(client, backend, api_key, model_id, tokens, requests=0):
+    """把预约的额度归还到该后端所用密钥的桶中"""
+    if client.limiter is not None and (tokens > 0 or requests > 0):
+        await asyncio.to_thread(client.limiter.refund, client.backends.api_key_for(backend, api_key),
+                                model_id, tokens, requests)
+
+async def test_model_availability_async(api_key, model_id, timeout, client):
+    """在事件循环上测试模型可用性，依次尝试可服务该模型的后端
+
+    探测同样占用所选后端的限流额度，在探测超时内都排不上时视为不可用。
+    """
     payload = {
         "messages": [{"role": "user", "content": "hi"}],
         "model": model_id,
         "max_tokens": 5
     }
-    
+
+    pool = client.backends
+    remaining = pool.candidates(model_id)
+    while remaining:
+        backend, wait = await reserve_backend(client, remaining, api_key, model_id, PROBE_TOKEN_COST, timeout)
+        if backend is None:
+            return False
+        remaining.remove(backend)
+        await asyncio.sleep(wait)
+        headers = {
+            "Authorization": f"Bearer {pool.api_key_for(backend, api_key)}",
+            "Content-Type": "application/json",
+        }
+        timings = {}
+        status_code = None
+        start = time.perf_counter()
+        try:
+            with pool.track(backend):
+                async with client.post(backend.url, headers=headers, json=payload, timeout=timeout,
+                                       timings=timings) as response:
+                    status_code = response.status_code
+        except Exception:
+            pass
+        finally:
+            client.telemetry.record(kind='probe', model=model_id, backend=backend.name, status=status_code,
+                                    connect_time=timings.get('connect_time', 0.0), ttfb=timings.get('ttfb'),
+                                    ttft=None, total_time=time.perf_counter() - start,
+                                    prompt_tokens=None, completion_tokens=None, tokens_per_second=None)
+
+        if status_code == 200:
+            pool.record_success(backend)
+            return True
+        if status_code is not None and not is_retryable_status(status_code):
+            # 后端可达但模型不可用（如未授权、不存在），不再换后端
+            pool.record_success(backend)
+            return False
+        pool.record_failure(backend)
+    return False
+
+async def probe_model(api_key, model_id, timeout, client, semaphore):
+    """探测单个模型，返回 (是否可用, 耗时秒数)"""
+    async with semaphore:
+        start = time.perf_counter()
+        available = await test_model_availability_async(api_key, model_id, timeout, client)
+        return available, time.perf_counter() - start
+
+def probe_models_concurrently(api_key, models, on_result=None,
+                              max_workers=None,
+                              deadline=PROBE_DEADLINE_SECONDS,
+                              client=None):
+    """在总截止时间内并发探测模型，按完成顺序回调 on_result(model, result)
+
+    默认所有模型同时探测，总耗时取决于最慢的单个探测；传入 max_workers 时限制同时在途的探测数。
+    """
+    results = {}
+    if not models:
+        return results
+
+    # 所有探测都提交到共享事件循环上，共用一个连接池，一次全部发出不会分批排队到截止时间；
+    # 其他会话正在探测同一密钥和模型时直接等待那次探测的结果
+    client = client or get_http_client()
+    single_flight = get_single_flight()
+    semaphore = asyncio.Semaphore(max(1, max_workers or len(models)))
+
+    def start_probe(model_id):
+        return lambda: client.submit(probe_model(api_key, model_id, PROBE_TIMEOUT_SECONDS, client, semaphore))
+
+    key_hash = hash_api_key(api_key)
+    futures = {single_flight.share(('probe', key_hash, model['id']), start_probe(model['id'])): model
+               for model in models}
+
     try:
-        response = requests.post(
-            "https://models.inference.ai.azure.com/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=10
+        for future in as_completed(futures, timeout=deadline):
+            model = futures[future]
+            available, latency = future.result()
+            results[model['id']] = {'available': available, 'latency': latency, 'timed_out': False}
+            if on_result:
+                on_result(model, results[model['id']])
+    except FuturesTimeoutError:
+        # 超过总截止时间的模型视为不可用，不再等待
+        for future, model in futures.items():
+            if model['id'] not in results:
+                results[model['id']] = {'available': False, 'latency': None, 'timed_out': True}
+                if on_result:
+                    on_result(model, results[model['id']])
+
+    # 超时的探测可能被其他会话共享，不主动取消，由单次探测超时兜底
+    return results
+
+def format_probe_status(model, result):
+    """格式化单个模型的探测结果"""
+    if result is None:
+        return f"⏳ {model['name']} 检测中..."
+    if result['timed_out']:
+        return f"⌛ {model['name']} 超时"
+    latency_ms = int(result['latency'] * 1000)
+    icon = "✅" if result['available'] else "❌"
+    return f"{icon} {model['name']} · {latency_ms} ms"
+
+def hash_api_key(api_key):
+    """计算API密钥的哈希，用作共享缓存的键（不落盘明文密钥）"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def open_availability_db():
+    """打开模型可用性缓存数据库"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(AVAILABILITY_DB_PATH, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS model_availability (
+            key_hash TEXT PRIMARY KEY,
+            results TEXT NOT NULL,
+            updated_at REAL NOT NULL
         )
-        return response.status_code == 200
-    except:
-        return False
+    """)
+    return conn
+
+def load_availability_row(api_key, conn=None):
+    """读取缓存条目（不论是否过期），返回 (探测结果, 更新时间) 或 None"""
+    own_conn = conn is None
+    if own_conn:
+        conn = open_availability_db()
+    try:
+        row = conn.execute(
+            "SELECT results, updated_at FROM model_availability WHERE key_hash = ?",
+            (hash_api_key(api_key),)
+        ).fetchone()
+    finally:
+        if own_conn:
+            conn.close()
+    return (json.loads(row[0]), row[1]) if row else None
+
+def get_availability_ttl(probe_results):
+    """缓存有效期：有模型探测超时时只短暂缓存，尽快重新探测"""
+    if any(result.get('timed_out') for result in probe_results.values()):
+        return AVAILABILITY_TIMEOUT_TTL_SECONDS
+    return AVAILABILITY_TTL_SECONDS
+
+def load_cached_availability(api_key):
+    """读取未过期的模型可用性缓存，返回 (探测结果, 更新时间) 或 None"""
+    try:
+        row = load_availability_row(api_key)
+    except sqlite3.Error:
+        return None
+
+    if not row or time.time() - row[1] > get_availability_ttl(row[0]):
+        return None
+    return row
+
+def store_cached_availability(api_key, probe_results):
+    """写入模型可用性缓存，并按更新时间淘汰超出容量的旧条目
+
+    探测超时的模型沿用上次的可用性结论（仍标记为超时，使该条目只短暂缓存）。
+    """
+    try:
+        conn = open_availability_db()
+        try:
+            with conn:
+                previous = load_availability_row(api_key, conn)
+                if previous:
+                    probe_results = dict(probe_results)
+                    for model_id, result in probe_results.items():
+                        old = previous[0].get(model_id)
+                        if result['timed_out'] and old and not old['timed_out']:
+                            probe_results[model_id] = dict(old, timed_out=True)
+                conn.execute(
+                    "INSERT OR REPLACE INTO model_availability (key_hash, results, updated_at) VALUES (?, ?, ?)",
+                    (hash_api_key(api_key), json.dumps(probe_results), time.time())
+                )
+                conn.execute(
+                    """DELETE FROM model_availability WHERE key_hash NOT IN (
+                        SELECT key_hash FROM model_availability ORDER BY updated_at DESC LIMIT ?
+                    )""",
+                    (AVAILABILITY_MAX_ENTRIES,)
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+class AvailabilityRefresher:
+    """后台线程：在缓存过期前重新探测本进程近期用过的密钥
+
+    超过缓存有效期没有使用、或条目已被容量淘汰的密钥不再刷新，并从内存中移除。
+    """
+
+    def __init__(self, client):
+        # 明文密钥只保存在本进程内存中：{密钥哈希: (密钥, 最近使用时间)}
+        self._api_keys = {}
+        self._client = client
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="availability-refresher", daemon=True)
+        self._thread.start()
+
+    def register(self, api_key):
+        with self._lock:
+            self._api_keys[hash_api_key(api_key)] = (api_key, time.time())
+
+    def _forget(self, key_hash, last_seen):
+        with self._lock:
+            # 期间再次使用过的密钥保留
+            if self._api_keys.get(key_hash, (None, None))[1] == last_seen:
+                del self._api_keys[key_hash]
+
+    def _run(self):
+        while True:
+            time.sleep(AVAILABILITY_REFRESH_INTERVAL_SECONDS)
+            with self._lock:
+                entries = list(self._api_keys.items())
+            for key_hash, (api_key, last_seen) in entries:
+                try:
+                    cached = load_availability_row(api_key)
+                except sqlite3.Error:
+                    continue
+                if cached is None or time.time() - last_seen > AVAILABILITY_TTL_SECONDS:
+                    self._forget(key_hash, last_seen)
+                    continue
+                # 其他进程可能已经刷新过，只处理即将过期的条目
+                ttl = get_availability_ttl(cached[0])
+                if time.time() - cached[1] < ttl - min(AVAILABILITY_REFRESH_AHEAD_SECONDS, ttl / 2):
+                    continue
+                probe_results = probe_models_concurrently(api_key, get_routable_models(),
+                                                          client=self._client)
+                store_cached_availability(api_key, probe_results)
+
+@st.cache_resource
+def get_availability_refresher():
+    """获取进程级的可用性后台刷新器"""
+    return AvailabilityRefresher(get_http_client())
+
+def get_routable_models():
+    """获取真实模型列表（不含智能路由入口）"""
+    return [m for m in get_all_supported_models() if m['id'] != AUTO_MODEL_ID]
+
+def apply_probe_results(probe_results, updated_at):
+    """根据探测结果更新当前会话的可用模型列表"""
+    all_models = get_all_supported_models()
+    available_models = [m for m in get_routable_models()
+                        if probe_results.get(m['id'], {}).get('available')]
+    st.session_state.model_probe_results = probe_results
+    st.session_state.available_models = [all_models[0]] + available_models if available_models else all_models
+    st.session_state.model_availability_updated_at = updated_at
 
 def get_system_prompt():
     """获取系统提示词"""
@@ -717,222 +2273,1486 @@ def get_system_prompt():
 请根据用户的问题提供最有价值的回答。
 """
 
-def call_ai_api(user_message, model_id, api_key):
-    """调用AI API进行对话"""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+def get_model_info(model_id):
+    """根据模型ID查找模型信息"""
+    return next((m for m in get_all_supported_models() if m['id'] == model_id), None)
 
-    messages = [{"role": "system", "content": get_system_prompt()}]
+def get_encoding_name(model_id):
+    """选择用于估算的分词器，非OpenAI模型使用 cl100k_base 近似"""
+    return "o200k_base" if model_id.startswith("gpt-4o") else "cl100k_base"
 
-    # 添加最近的聊天历史
-    if st.session_state.chat_messages:
-        recent_messages = st.session_state.chat_messages[-10:]
-        for msg in recent_messages:
-            if msg['role'] in ['user', 'assistant']:
-                messages.append({
-                    "role": msg['role'],
-                    "content": msg['content']
-                })
+@st.cache_resource(show_spinner=False)
+def get_token_encoding(encoding_name):
+    """加载并缓存tiktoken分词器，无法加载时返回 None"""
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception:
+        return None
 
-    messages.append({"role": "user", "content": user_message})
+def count_tokens(text, encoding_name):
+    """计算文本的token数"""
+    encoding = get_token_encoding(encoding_name)
+    if encoding is None:
+        # 分词器不可用时保守估算：中文约每3字节一个token
+        return len(text.encode('utf-8')) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
 
+def count_message_tokens(msg, encoding_name):
+    """计算单条消息的token数，结果缓存在消息上，只对新消息分词"""
+    if msg.token_cache is None or msg.token_cache[0] != encoding_name:
+        msg.token_cache = (encoding_name, count_tokens(msg.content, encoding_name) + TOKENS_PER_MESSAGE)
+    return msg.token_cache[1]
+
+def get_prompt_budget(model_id, max_tokens=MAX_COMPLETION_TOKENS):
+    """计算模型可用于输入的token预算（已为回复预留 max_tokens）"""
+    model = get_model_info(model_id)
+    context_window = model['context_window'] if model else 8192
+    return min(context_window - max_tokens, MAX_PROMPT_TOKENS) - CONTEXT_SAFETY_MARGIN
+
+def build_context_messages(history, user_message, model_id, max_tokens=MAX_COMPLETION_TOKENS, summary=None):
+    """在token预算内从最新往前装入历史消息，返回 (消息列表, 输入token数)
+
+    传入会话摘要时，摘要作为一条系统消息放在最前，已并入摘要的消息不再逐条发送。
+    """
+    encoding_name = get_encoding_name(model_id)
+    system_prompt = get_system_prompt()
+
+    used_tokens = (count_tokens(system_prompt, encoding_name)
+                   + count_tokens(user_message, encoding_name)
+                   + 2 * TOKENS_PER_MESSAGE)
+    budget = get_prompt_budget(model_id, max_tokens)
+
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": f"以下是此前对话的摘要：\n{summary['text']}"}
+        used_tokens += count_tokens(summary_message['content'], encoding_name) + TOKENS_PER_MESSAGE
+
+    # 当前这条用户消息已追加到历史末尾，不重复发送
+    if history and history[-1]['role'] == 'user' and history[-1]['content'] == user_message:
+        history = history[:-1]
+
+    selected = []
+    for msg in reversed(history):
+        if msg['role'] not in ['user', 'assistant']:
+            continue
+        if summary and msg.get('id') is not None and msg['id'] <= summary['covered_id']:
+            break
+        msg_tokens = count_message_tokens(msg, encoding_name)
+        if used_tokens + msg_tokens > budget:
+            break
+        used_tokens += msg_tokens
+        selected.append({"role": msg['role'], "content": msg['content']})
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary_message:
+        messages.append(summary_message)
+    messages.extend(reversed(selected))
+    messages.append({"role": "user", "content": user_message})
+    return messages, used_tokens
+
+def describe_api_error(status_code, model_id):
+    """将HTTP错误状态转换为提示文本"""
+    if status_code == 401:
+        return "❌ API认证失败，请检查密钥"
+    elif status_code == 404:
+        return f"❌ 模型 {model_id} 不可用"
+    elif status_code == 429:
+        return f"❌ 模型 {model_id} 请求过于频繁，请稍后重试"
+    return f"❌ API调用失败: {status_code}"
+
+async def iter_sse_content(response):
+    """逐条解析SSE响应，产出增量文本"""
+    # SSE 响应通常不带 charset，需显式指定以免中文乱码
+    response.encoding = 'utf-8'
+    async for line in response.aiter_lines():
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        choices = chunk.get('choices') or []
+        if not choices:
+            continue
+        content = (choices[0].get('delta') or {}).get('content')
+        if content:
+            yield content
+
+class ResponseCache:
+    """完全相同请求的回复缓存：内存LRU + 磁盘SQLite两级，均带过期时间"""
+
+    def __init__(self, db_path=RESPONSE_CACHE_DB_PATH, ttl=RESPONSE_CACHE_TTL_SECONDS,
+                 memory_entries=RESPONSE_CACHE_MEMORY_ENTRIES, disk_entries=RESPONSE_CACHE_DISK_ENTRIES):
+        self._db_path = db_path
+        self._ttl = ttl
+        self._memory_entries = memory_entries
+        self._disk_entries = disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_trim = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_id, messages, temperature, max_tokens):
+        """由模型、完整消息列表和生成参数计算缓存键"""
+        raw = json.dumps([model_id, messages, temperature, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _open_db(self):
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+        conn = sqlite3.connect(self._db_path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        return conn
+
+    def _remember(self, key, content, created_at):
+        self._entries[key] = (content, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._memory_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """读取缓存，未命中或已过期时返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] <= self._ttl:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+
+        try:
+            conn = self._open_db()
+            try:
+                row = conn.execute(
+                    "SELECT content, created_at FROM response_cache WHERE cache_key = ?", (key,)
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            row = None
+
+        with self._lock:
+            if row and now - row[1] <= self._ttl:
+                self._remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return row[0]
+            self.misses += 1
+        return None
+
+    def put(self, key, content):
+        """写入两级缓存，并定期清理过期和超量的磁盘条目"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+            self._puts_since_trim += 1
+            trim = self._puts_since_trim >= 100
+            if trim:
+                self._puts_since_trim = 0
+
+        try:
+            conn = self._open_db()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO response_cache (cache_key, content, created_at) VALUES (?, ?, ?)",
+                        (key, content, now)
+                    )
+                    if trim:
+                        conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self._ttl,))
+                        conn.execute(
+                            """DELETE FROM response_cache WHERE cache_key NOT IN (
+                                SELECT cache_key FROM response_cache ORDER BY created_at DESC LIMIT ?
+                            )""",
+                            (self._disk_entries,)
+                        )
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """返回命中与未命中次数"""
+        with self._lock:
+            return {
+                'hits': self.memory_hits + self.disk_hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+@st.cache_resource
+def get_response_cache():
+    """获取进程级共享的响应缓存"""
+    return ResponseCache()
+
+MINHASH_PRIME = (1 << 61) - 1
+
+def normalize_for_fingerprint(text):
+    """归一化文本：全半角统一、小写，去掉标点、空白和符号"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in 'PZSC')
+
+def char_ngrams(text, n=NEAR_DUP_NGRAM):
+    """字符n-gram集合，文本短于n时整体作为一个元素"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def get_fingerprint_context(messages):
+    """取请求中最近几条上下文消息（不含系统提示和当前问题）用于比较"""
+    context = [msg['content'] for msg in messages[1:-1][-NEAR_DUP_CONTEXT_MESSAGES:]]
+    return "\n".join(context)[-NEAR_DUP_CONTEXT_CHARS:]
+
+class NearDuplicateCache:
+    """相似问题缓存：对归一化后的问题和上下文计算MinHash签名，用LSH分桶快速找候选"""
+
+    def __init__(self, num_perm=NEAR_DUP_NUM_PERM, bands=NEAR_DUP_BANDS,
+                 max_entries=NEAR_DUP_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL_SECONDS):
+        rng = random.Random(20250808)
+        self._perms = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME))
+                       for _ in range(num_perm)]
+        self._bands = bands
+        self._rows = num_perm // bands
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()   # entry_id -> (model_id, 问题签名, 上下文签名, 回复, 写入时间)
+        self._buckets = {}              # (model_id, 分桶序号, 分桶签名) -> {entry_id}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.total_lookup_time = 0.0
+
+    def _signature(self, text):
+        shingles = char_ngrams(normalize_for_fingerprint(text))
+        if not shingles:
+            return None
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big')
+                  for s in shingles]
+        return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in self._perms)
+
+    def _band_keys(self, model_id, signature):
+        return [(model_id, band, signature[band * self._rows:(band + 1) * self._rows])
+                for band in range(self._bands)]
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        """用签名相同位置的比例估算Jaccard相似度"""
+        if sig_a is None or sig_b is None:
+            return 1.0 if sig_a == sig_b else 0.0
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    def _evict(self, entry_id):
+        model_id, prompt_sig = self._entries.pop(entry_id)[:2]
+        for key in self._band_keys(model_id, prompt_sig):
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def lookup(self, model_id, prompt, context_text, threshold=NEAR_DUP_THRESHOLD):
+        """查找问题和上下文都足够相似的缓存回复，未找到返回 None"""
+        start = time.perf_counter()
+        prompt_sig = self._signature(prompt)
+        context_sig = self._signature(context_text)
+        result = None
+
+        with self._lock:
+            if prompt_sig is not None:
+                candidates = set()
+                for key in self._band_keys(model_id, prompt_sig):
+                    candidates |= self._buckets.get(key, set())
+
+                best_score = 0.0
+                now = time.time()
+                for entry_id in candidates:
+                    _, cand_prompt_sig, cand_context_sig, content, created_at = self._entries[entry_id]
+                    if now - created_at > self._ttl:
+                        continue
+                    prompt_score = self.similarity(prompt_sig, cand_prompt_sig)
+                    # 上下文也必须相似，避免同一段对话里不同的短问题误命中
+                    if (prompt_score >= threshold and prompt_score > best_score
+                            and self.similarity(context_sig, cand_context_sig) >= threshold):
+                        best_score = prompt_score
+                        result = content
+
+            self.lookups += 1
+            if result is not None:
+                self.hits += 1
+            self.total_lookup_time += time.perf_counter() - start
+        return result
+
+    def add(self, model_id, prompt, context_text, content):
+        """索引一条问答"""
+        prompt_sig = self._signature(prompt)
+        if prompt_sig is None:
+            return
+        context_sig = self._signature(context_text)
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (model_id, prompt_sig, context_sig, content, time.time())
+            for key in self._band_keys(model_id, prompt_sig):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self._max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def stats(self):
+        """返回查找次数、命中率和平均查找耗时"""
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'avg_lookup_ms': self.total_lookup_time / self.lookups * 1000 if self.lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+@st.cache_resource
+def get_near_duplicate_cache():
+    """获取进程级共享的相似问题缓存"""
+    return NearDuplicateCache()
+
+class ModelHealthTracker:
+    """记录每个模型最近一段时间的调用延迟和成败，用于智能路由"""
+
+    def __init__(self, window_size=ROUTING_WINDOW_SIZE, window_seconds=ROUTING_WINDOW_SECONDS):
+        self._window_size = window_size
+        self._window_seconds = window_seconds
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_id, latency, success):
+        with self._lock:
+            samples = self._samples.setdefault(model_id, deque(maxlen=self._window_size))
+            samples.append((time.time(), latency, success))
+
+    def summary(self, model_id):
+        """返回窗口内的 (样本数, p90延迟, 错误率)，没有样本时返回 None"""
+        cutoff = time.time() - self._window_seconds
+        with self._lock:
+            samples = [s for s in self._samples.get(model_id, ()) if s[0] >= cutoff]
+        if not samples:
+            return None
+        latencies = sorted(s[1] for s in samples if s[2])
+        errors = sum(1 for s in samples if not s[2])
+        p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))] if latencies else None
+        return len(samples), p90, errors / len(samples)
+
+    def latency_percentile(self, model_id, quantile, min_samples=1):
+        """窗口内成功调用延迟的分位数，样本不足时返回 None"""
+        cutoff = time.time() - self._window_seconds
+        with self._lock:
+            latencies = sorted(s[1] for s in self._samples.get(model_id, ()) if s[0] >= cutoff and s[2])
+        if len(latencies) < min_samples or not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * quantile))]
+
+@st.cache_resource
+def get_model_health():
+    """获取进程级共享的模型健康统计"""
+    return ModelHealthTracker()
+
+def route_model(tier):
+    """在指定档位中选择当前延迟和错误率综合最优的模型，返回 (模型ID, 评分说明)"""
+    available_ids = {m['id'] for m in st.session_state.available_models}
+    candidates = [model_id for model_id in ROUTING_TIERS[tier] if model_id in available_ids]
+    if not candidates:
+        candidates = ROUTING_TIERS[tier]
+
+    health = get_model_health()
+    breakers = get_circuit_breakers()
+    scored = []
+    for preference, model_id in enumerate(candidates):
+        if breakers.get(model_id).snapshot()[0] == 'open':
+            continue
+        summary = health.summary(model_id)
+        if summary is None:
+            # 没有调用样本时参考探测延迟
+            probe_result = st.session_state.model_probe_results.get(model_id) or {}
+            latency, error_rate = probe_result.get('latency') or ROUTING_DEFAULT_LATENCY, 0.0
+        else:
+            _, p90, error_rate = summary
+            latency = p90 if p90 is not None else ROUTING_DEFAULT_LATENCY
+        acceptable = error_rate <= ROUTING_MAX_ERROR_RATE
+        scored.append((not acceptable, latency * (1 + 4 * error_rate), preference, model_id, latency, error_rate))
+
+    if not scored:
+        # 全部熔断时仍按偏好选择第一个，由熔断器给出提示
+        return candidates[0], "候选模型均已熔断"
+
+    _, _, _, model_id, latency, error_rate = min(scored)
+    return model_id, f"p90 {latency:.1f}s · 错误率 {error_rate:.0%}"
+
+def resolve_model(model_id):
+    """将智能路由解析为具体模型，其他模型原样返回"""
+    if model_id != AUTO_MODEL_ID:
+        return model_id
+    routed_id, reason = route_model(st.session_state.routing_tier)
+    st.session_state.last_route = {'model': routed_id, 'reason': reason}
+    return routed_id
+
+def is_retryable_status(status_code):
+    """限流和服务端错误可以重试"""
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+def parse_retry_after(headers):
+    """解析 Retry-After 头（秒数或HTTP日期），无法解析时返回 None"""
+    value = headers.get('retry-after') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_backoff_delay(attempt, retry_after=None):
+    """带随机抖动的指数退避；服务端给出 Retry-After 时以其为准"""
+    if retry_after is not None:
+        return min(retry_after + random.uniform(0, RETRY_BASE_DELAY_SECONDS), RETRY_MAX_DELAY_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+class CircuitBreaker:
+    """单个模型的熔断器：closed → open（快速失败）→ half_open（放行一次试探）"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, recovery_timeout=BREAKER_RECOVERY_SECONDS):
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow_request(self):
+        """判断是否放行请求；半开状态下同一时间只放行一个试探请求"""
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self._recovery_timeout:
+                    return False
+                self.state = 'half_open'
+                self._trial_in_flight = False
+            if self.state == 'half_open':
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def release(self):
+        """放弃已放行的请求（没有实际发出），半开状态下让出试探名额"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self._failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        """返回 (状态, 距离半开的剩余秒数)"""
+        with self._lock:
+            if self.state == 'open':
+                remaining = self._recovery_timeout - (time.monotonic() - self.opened_at)
+                if remaining <= 0:
+                    return 'half_open', 0
+                return 'open', remaining
+            return self.state, 0
+
+class CircuitBreakerRegistry:
+    """按模型ID管理熔断器"""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_id):
+        with self._lock:
+            if model_id not in self._breakers:
+                self._breakers[model_id] = CircuitBreaker()
+            return self._breakers[model_id]
+
+@st.cache_resource
+def get_circuit_breakers():
+    """获取进程级共享的熔断器表"""
+    return CircuitBreakerRegistry()
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你负责维护一段对话的滚动摘要。把新的对话内容并入已有摘要，保留关键事实、用户偏好、"
+    "已得出的结论和尚未解决的问题，删去寒暄和重复内容。只输出更新后的摘要。"
+)
+
+def format_summary_line(msg):
+    """并入摘要时单条消息的文本（过长的消息截断）"""
+    return f"{'用户' if msg['role'] == 'user' else '助手'}：{msg['content'][:SUMMARY_MESSAGE_CHARS]}"
+
+def build_summary_prompt(summary, lines):
+    """构造把新消息并入已有摘要的请求消息"""
+    transcript = "\n".join(lines)
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"已有摘要：\n{summary or '（无）'}\n\n新的对话：\n{transcript}"},
+    ]
+
+def plan_summary_batch(summary, messages, more_pending):
+    """挑选本轮并入摘要的消息，返回 (消息列表, 请求消息, 输入token数)，不需要压缩时返回 None
+
+    待压缩的较早消息不足 SUMMARY_TRIGGER_TOKENS 时不压缩；一轮并入的消息按token数截断到
+    摘要模型的输入预算以内，其余留给下一轮。分词较耗CPU，应在工作线程中调用。
+    """
+    if more_pending:
+        candidates = messages
+    else:
+        candidates = messages[:-SUMMARY_KEEP_RECENT_MESSAGES] if len(messages) > SUMMARY_KEEP_RECENT_MESSAGES else []
+    encoding_name = get_encoding_name(SUMMARY_MODEL)
+    lines = [format_summary_line(msg) for msg in candidates]
+    line_tokens = [count_tokens(line, encoding_name) + 1 for line in lines]
+    if sum(line_tokens) < SUMMARY_TRIGGER_TOKENS:
+        return None
+
+    used_tokens = count_tokens(build_summary_prompt(summary, [])[1]['content'], encoding_name) \
+        + count_tokens(SUMMARY_SYSTEM_PROMPT, encoding_name) + 2 * TOKENS_PER_MESSAGE
+    budget = get_prompt_budget(SUMMARY_MODEL, SUMMARY_MAX_TOKENS)
+    count = 0
+    for tokens in line_tokens:
+        # 至少并入一条，单条消息已按字符数截断，不会超出预算太多
+        if count and used_tokens + tokens > budget:
+            break
+        used_tokens += tokens
+        count += 1
+    return candidates[:count], build_summary_prompt(summary, lines[:count]), used_tokens
+
+class ConversationSummarizer:
+    """后台滚动摘要：会话中较早的消息超过阈值时，用低成本模型把它们增量并入会话摘要"""
+
+    def __init__(self, client):
+        self._client = client
+        self._running = set()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+
+    def schedule(self, owner, session_id, api_key):
+        """在共享事件循环上检查并压缩该会话，同一会话同时只有一个任务"""
+        if not api_key:
+            return
+        with self._lock:
+            if session_id in self._running:
+                return
+            self._running.add(session_id)
+        future = self._client.submit(self._summarize(owner, session_id, api_key))
+        future.add_done_callback(lambda _: self._finish(session_id))
+
+    def _finish(self, session_id):
+        with self._lock:
+            self._running.discard(session_id)
+
+    async def _summarize(self, owner, session_id, api_key):
+        # 数据库读写和分词都放到工作线程，不阻塞共享事件循环上的其他请求
+        while True:
+            existing = await asyncio.to_thread(store_get_summary, owner, session_id)
+            covered_id = existing['covered_id'] if existing else 0
+            limit = SUMMARY_BATCH_MESSAGES + SUMMARY_KEEP_RECENT_MESSAGES
+            messages = await asyncio.to_thread(store_load_messages_after, owner, session_id, covered_id, limit)
+            more_pending = len(messages) == limit
+            if more_pending:
+                # 后面还有更多消息，本轮最多并入一整批
+                messages = messages[:SUMMARY_BATCH_MESSAGES]
+            plan = await asyncio.to_thread(plan_summary_batch, existing['text'] if existing else "",
+                                           messages, more_pending)
+            if plan is None:
+                return
+            foldable, prompt_messages, prompt_tokens = plan
+
+            payload = {
+                "messages": prompt_messages,
+                "model": SUMMARY_MODEL,
+                "max_tokens": SUMMARY_MAX_TOKENS,
+                "temperature": 0.2,
+            }
+            content, success, metrics = await chat_completion_async(api_key, payload, None, self._client,
+                                                                    token_cost=prompt_tokens + SUMMARY_MAX_TOKENS,
+                                                                    prompt_tokens=prompt_tokens)
+            if metrics.get('queue_full'):
+                # 限流额度排不上，留到下次发送消息后再压缩
+                return
+            with self._lock:
+                self.runs += 1
+                self.failures += int(not success)
+            if not success or not content.strip():
+                return
+            saved = await asyncio.to_thread(store_save_summary, session_id, content.strip(), foldable[-1]['id'],
+                                            existing['covered_id'] if existing else None)
+            if not saved:
+                return
+
+@st.cache_resource
+def get_summarizer():
+    """获取进程级的会话摘要器"""
+    return ConversationSummarizer(get_http_client())
+
+class HedgeCancelled(Exception):
+    """对冲请求中落败的一方被取消"""
+
+class HedgeStats:
+    """统计对冲带来的额外请求和节省的时间"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+        self.time_saved = 0.0
+
+    def record(self, hedged, hedge_won, time_saved):
+        with self._lock:
+            self.requests += 1
+            self.hedges_sent += int(hedged)
+            self.hedge_wins += int(hedge_won)
+            self.time_saved += time_saved
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedges_sent': self.hedges_sent,
+                'hedge_wins': self.hedge_wins,
+                'time_saved': self.time_saved,
+                'overhead': self.hedges_sent / self.requests if self.requests else 0.0,
+            }
+
+@st.cache_resource
+def get_hedge_stats():
+    """获取进程级共享的对冲统计"""
+    return HedgeStats()
+
+def get_hedge_delay(model_id):
+    """根据模型最近的 p95 首字延迟决定何时发出对冲请求，样本不足时不对冲"""
+    p95 = get_model_health().latency_percentile(model_id, 0.95, HEDGE_MIN_SAMPLES)
+    if p95 is None:
+        return None
+    return min(max(p95, HEDGE_MIN_DELAY_SECONDS), HEDGE_MAX_DELAY_SECONDS)
+
+def send_hedged(api_key, payload, on_token=None, token_cost=0, on_wait=None, prompt_tokens=None):
+    """对冲请求：主请求超过 p95 仍无首字时，再向同一模型或备用模型发一份，先出首字者胜出
+
+    请求在后台线程中以流式方式发送；一方出首字或完成时立即取消另一方，释放其连接。
+    胜出方的增量文本在调用线程中转交给 on_token，指标中的 served_by 是实际回复的模型。
+    对冲请求不排队，限流额度不足时放弃对冲继续等主请求。
+    """
+    model_id = payload['model']
+    client = get_http_client()
+    hedge_delay = get_hedge_delay(model_id)
+    if hedge_delay is None:
+        get_hedge_stats().record(False, False, 0.0)
+        return send_chat_completion(api_key, payload, on_token, client, token_cost=token_cost, on_wait=on_wait,
+                                    prompt_tokens=prompt_tokens)
+
+    events = queue.Queue()
+    attempts = []
+    start = time.perf_counter()
+
+    def launch(target_model):
+        index = len(attempts)
+        attempt = {'model': target_model, 'cancel': threading.Event(), 'future': None,
+                   'first_token': None, 'done': False, 'sent': True}
+        attempts.append(attempt)
+
+        def on_attempt_token(content):
+            if attempt['cancel'].is_set():
+                raise HedgeCancelled()
+            events.put((index, 'token', content))
+
+        def on_attempt_wait(wait):
+            events.put((index, 'wait', wait))
+
+        def on_submit(future):
+            attempt['future'] = future
+            if attempt['cancel'].is_set():
+                future.cancel()
+
+        def run():
+            result = send_chat_completion(api_key, dict(payload, model=target_model), on_attempt_token, client,
+                                          on_submit=on_submit, token_cost=token_cost, on_wait=on_attempt_wait,
+                                          max_wait=0 if index else None, prompt_tokens=prompt_tokens)
+            events.put((index, 'done', result))
+
+        threading.Thread(target=run, name=f"hedge-{index}", daemon=True).start()
+
+    def cancel_others(winner_index):
+        for index, attempt in enumerate(attempts):
+            if index != winner_index:
+                attempt['cancel'].set()
+                if attempt['future'] is not None:
+                    attempt['future'].cancel()
+
+    launch(model_id)
+    hedge_at = start + hedge_delay
+    winner = None
+    while True:
+        timeout = None
+        if len(attempts) == 1 and winner is None:
+            timeout = max(0.0, hedge_at - time.perf_counter())
+        try:
+            index, kind, value = events.get(timeout=timeout)
+        except queue.Empty:
+            launch(HEDGE_FALLBACK_MODELS.get(model_id, model_id))
+            continue
+
+        attempt = attempts[index]
+        if kind == 'wait':
+            # 主请求在限流队列中等待时，对冲计时从排到之后算起
+            if index == 0:
+                hedge_at += value
+                if on_wait:
+                    on_wait(value)
+            continue
+        if kind == 'token':
+            if attempt['first_token'] is None:
+                attempt['first_token'] = time.perf_counter() - start
+            if winner is None:
+                winner = index
+                # 胜负已分，立即取消另一方（它可能仍卡在等待首字）
+                cancel_others(winner)
+            if index == winner and on_token:
+                on_token(value)
+            continue
+
+        attempt['done'] = True
+        content, success, metrics = value
+        attempt['sent'] = not (metrics or {}).get('queue_full')
+        if winner is None and not success and not all(a['done'] for a in attempts):
+            continue
+        if winner is None:
+            winner = index
+        if index != winner:
+            continue
+        cancel_others(winner)
+
+        hedged = len(attempts) > 1 and attempts[1]['sent']
+        hedge_won = hedged and winner == 1
+        time_saved = 0.0
+        if hedge_won and attempts[1]['first_token'] is not None:
+            # 主请求尚未出首字时，节省时间至少是到现在为止的差值
+            primary_first_token = attempts[0]['first_token'] or (time.perf_counter() - start)
+            time_saved = max(0.0, primary_first_token - attempts[1]['first_token'])
+        get_hedge_stats().record(hedged, hedge_won, time_saved)
+
+        if success:
+            metrics = dict(metrics,
+                           served_by=attempts[winner]['model'],
+                           hedged=hedged,
+                           total_time=time.perf_counter() - start,
+                           time_to_first_token=attempts[winner]['first_token'])
+        return content, success, metrics
+
+def send_with_retries(api_key, payload, on_token=None, hedge=False, token_cost=0, on_wait=None, prompt_tokens=None):
+    """经过熔断器发送请求，对限流和服务端错误按退避策略重试
+
+    每次尝试在选定后端时按 token_cost 预约该后端的限流额度，需要排队时先回调 on_wait(预计等待秒数) 再等待。
+    """
+    model_id = payload['model']
+    breaker = get_circuit_breakers().get(model_id)
+    deadline = time.monotonic() + RETRY_BUDGET_SECONDS
+
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        if not breaker.allow_request():
+            return f"❌ 模型 {model_id} 暂时不可用（已熔断），请稍后重试或切换模型", False, None
+
+        outcome_recorded = False
+        try:
+            attempt_start = time.perf_counter()
+            if hedge:
+                content, success, metrics = send_hedged(api_key, payload, on_token, token_cost, on_wait,
+                                                        prompt_tokens)
+            else:
+                content, success, metrics = send_chat_completion(api_key, payload, on_token,
+                                                                 token_cost=token_cost, on_wait=on_wait,
+                                                                 prompt_tokens=prompt_tokens)
+            if metrics.get('queue_full'):
+                # 所有后端的限流额度都排不上，请求没有发出，不计入熔断（由 finally 让出试探名额）
+                return content, success, None
+            if success:
+                breaker.record_success()
+                outcome_recorded = True
+                get_model_health().record(metrics.get('served_by', model_id),
+                                          metrics.get('time_to_first_token') or metrics['total_time'], True)
+                return content, success, dict(metrics, attempts=attempt + 1)
+
+            status_code = metrics['status_code']
+            if status_code is not None and not is_retryable_status(status_code):
+                # 认证失败、模型不存在等不代表模型过载
+                breaker.record_success()
+                outcome_recorded = True
+                return content, success, metrics
+
+            breaker.record_failure()
+            outcome_recorded = True
+        finally:
+            # 回调中途中止（如页面重跑）时没有结果，让出半开状态的试探名额
+            if not outcome_recorded:
+                breaker.release()
+
+        get_model_health().record(model_id, time.perf_counter() - attempt_start, False)
+        if status_code is None or attempt == RETRY_MAX_ATTEMPTS - 1:
+            # 连接错误和超时不再重试，避免长时间占用
+            return content, success, metrics
+
+        delay = get_backoff_delay(attempt, metrics['retry_after'])
+        if time.monotonic() + delay > deadline:
+            return content, success, metrics
+        time.sleep(delay)
+
+    return content, success, metrics
+
+async def chat_completion_async(api_key, payload, on_update, client, token_cost=0, on_wait=None, max_wait=None,
+                                prompt_tokens=None):
+    """在事件循环上发送一次对话请求，返回 (回复内容, 是否成功, 指标)
+
+    每次选择后端时按该后端的密钥预约 token_cost 的限流额度，优先选无需排队的后端，
+    都需要排队时回调 on_wait(预计等待秒数) 后等待；所有后端都排不上时返回失败，指标中 queue_full 为 True。
+    连接失败、限流或服务端错误且尚未收到任何内容时，立即换下一个后端。
+    传入 on_update 时使用流式输出，每收到一段文本就以累计内容回调一次（on_update 和 on_wait 都在事件循环线程中调用）。
+    prompt_tokens 是调用方已算好的输入token数，仅用于遥测，事件循环上不再分词。
+    """
+    pool = client.backends
+    model_id = payload['model']
+    remaining = pool.candidates(model_id)
+    if not remaining:
+        return f"❌ 没有配置可提供模型 {model_id} 的后端", False, {'status_code': 404, 'retry_after': None}
+    result = None
+    while remaining:
+        backend, wait = await reserve_backend(client, remaining, api_key, model_id, token_cost, max_wait)
+        if backend is None:
+            # 已经试过的后端失败时返回那次的错误，否则说明所有后端的额度都排不上
+            return result or (f"❌ 模型 {model_id} 请求排队过长，请稍后再试", False,
+                              {'status_code': None, 'retry_after': None, 'queue_full': True})
+        remaining.remove(backend)
+        try:
+            if wait > 0:
+                if on_wait:
+                    on_wait(wait)
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # 排队期间被取消（如对冲落败），请求没有发出，归还全部额度
+            await asyncio.shield(refund_backend(client, backend, api_key, model_id, token_cost, requests=1))
+            raise
+
+        try:
+            content, success, metrics = await chat_completion_on_backend(
+                backend, api_key, payload, on_update, client, prompt_tokens
+            )
+        except Exception as e:
+            pool.record_failure(backend)
+            await refund_backend(client, backend, api_key, model_id, token_cost)
+            if not remaining or getattr(e, 'content_started', False):
+                raise
+            continue
+
+        if success:
+            pool.record_success(backend)
+            if token_cost and metrics.get('completion_tokens') is not None:
+                # 按最大回复长度预约的 token，归还未用完的部分
+                unused_tokens = min(token_cost, payload.get('max_tokens', 0) - metrics['completion_tokens'])
+                await refund_backend(client, backend, api_key, model_id, unused_tokens)
+            return content, success, dict(metrics, backend=backend.name)
+
+        # 失败的请求没有生成回复，归还本次预约的 token
+        await refund_backend(client, backend, api_key, model_id, token_cost)
+        result = (content, success, metrics)
+        if not is_retryable_status(metrics['status_code']):
+            pool.record_success(backend)
+            return content, success, dict(metrics, backend=backend.name)
+        pool.record_failure(backend)
+    return result
+
+async def chat_completion_on_backend(backend, api_key, payload, on_update, client, prompt_tokens=None):
+    """向指定后端发送一次对话请求；已收到内容后出错时在异常上标记 content_started"""
+    headers = {
+        "Authorization": f"Bearer {client.backends.api_key_for(backend, api_key)}",
+        "Content-Type": "application/json",
+    }
+    stream = on_update is not None
+    if stream:
+        payload = dict(payload, stream=True)
+
+    timings = {}
+    telemetry = {'status': None, 'ttft': None, 'prompt_tokens': prompt_tokens,
+                 'completion_tokens': None, 'tokens_per_second': None}
+    first_token_time = None
+    start = time.perf_counter()
+    try:
+        with client.backends.track(backend):
+            async with client.post(backend.url, headers=headers, json=payload, timeout=30,
+                                   timings=timings) as response:
+                telemetry['status'] = response.status_code
+                if response.status_code != 200:
+                    error = {
+                        'status_code': response.status_code,
+                        'retry_after': parse_retry_after(response.headers),
+                    }
+                    return describe_api_error(response.status_code, payload['model']), False, error
+
+                if not stream:
+                    await response.aread()
+                    result = response.json()
+                    usage = result.get('usage') or {}
+                    telemetry['prompt_tokens'] = usage.get('prompt_tokens', prompt_tokens)
+                    telemetry['completion_tokens'] = usage.get('completion_tokens')
+                    metrics = {
+                        'stream': False,
+                        'total_time': time.perf_counter() - start,
+                        'completion_tokens': telemetry['completion_tokens'],
+                    }
+                    return result['choices'][0]['message']['content'], True, metrics
+
+                content = ""
+                chunk_count = 0
+                async for delta in iter_sse_content(response):
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                    content += delta
+                    chunk_count += 1
+                    on_update(content)
+
+        end = time.perf_counter()
+        generation_time = end - first_token_time if first_token_time else 0
+        metrics = {
+            'stream': True,
+            'total_time': end - start,
+            'time_to_first_token': first_token_time - start if first_token_time else None,
+            # 每个SSE增量块通常对应一个token
+            'tokens_per_second': chunk_count / generation_time if generation_time > 0 else None,
+            'completion_tokens': chunk_count,
+        }
+        telemetry.update(ttft=metrics['time_to_first_token'], completion_tokens=chunk_count,
+                         tokens_per_second=metrics['tokens_per_second'])
+        return content, True, metrics
+    except Exception as e:
+        e.content_started = first_token_time is not None
+        raise
+    finally:
+        client.telemetry.record(kind='chat', model=payload['model'], backend=backend.name,
+                                connect_time=timings.get('connect_time', 0.0), ttfb=timings.get('ttfb'),
+                                total_time=time.perf_counter() - start, **telemetry)
+
+def send_chat_completion(api_key, payload, on_token=None, client=None, on_submit=None,
+                         token_cost=0, on_wait=None, max_wait=None, prompt_tokens=None):
+    """发送一次对话请求（同步桥），返回 (回复内容, 是否成功, 指标)
+
+    请求在共享事件循环上执行；传入 on_token 时，流式文本经队列转交到调用线程回调，
+    限流排队的预计等待也经同一队列转交给 on_wait。
+    on_token 抛出异常或请求的 future 被取消时中止请求；on_submit 在提交后收到该 future。
+    失败时指标中包含 status_code（连接错误为 None）和 retry_after。
+    """
+    client = client or get_http_client()
+    events = queue.Queue() if on_token or on_wait else None
+    on_update = (lambda content: events.put(('token', content))) if on_token else None
+    on_queued = (lambda wait: events.put(('wait', wait))) if on_wait else None
+    future = client.submit(chat_completion_async(api_key, payload, on_update, client,
+                                                 token_cost, on_queued, max_wait, prompt_tokens))
+    if on_submit:
+        on_submit(future)
+    try:
+        if events:
+            future.add_done_callback(lambda _: events.put(None))
+            for kind, value in iter(events.get, None):
+                (on_token if kind == 'token' else on_wait)(value)
+        return future.result()
+    except Exception as e:
+        future.cancel()
+        return f"❌ 连接错误: {str(e)[:100]}", False, {'status_code': None, 'retry_after': None}
+
+def call_ai_api(user_message, model_id, api_key, on_token=None, on_wait=None):
+    """调用AI API进行对话，返回 (回复内容, 是否成功, 实际回复的模型ID)
+
+    开启响应缓存时，相同模型、相同上下文和参数的请求直接返回缓存的回复；
+    开启相似问题缓存时，问题和上下文足够相似的请求也会复用之前的回复。
+    成功的调用会在 st.session_state.last_response_metrics 中记录耗时等指标。
+    请求超过限流额度时排队等待，on_wait 收到预计等待的秒数。
+    """
+    start = time.perf_counter()
+    session_id = st.session_state.current_session_id
+    owner = get_session_owner()
+    summary = store_get_summary(owner, session_id) if session_id and owner else None
+    messages, prompt_tokens = build_context_messages(
+        st.session_state.chat_messages, user_message, model_id, summary=summary
+    )
     payload = {
         "messages": messages,
         "model": model_id,
-        "max_tokens": 2000,
-        "temperature": 0.7
+        "max_tokens": MAX_COMPLETION_TOKENS,
+        "temperature": DEFAULT_TEMPERATURE
     }
 
-    try:
-        response = requests.post(
-            "https://models.inference.ai.azure.com/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+    cache = get_response_cache() if st.session_state.response_cache_enabled else None
+    near_cache = get_near_duplicate_cache() if st.session_state.near_dup_cache_enabled else None
+    cached_content = None
+    if cache:
+        cache_key = ResponseCache.make_key(model_id, messages, DEFAULT_TEMPERATURE, MAX_COMPLETION_TOKENS)
+        cached_content = cache.get(cache_key)
+        cache_source = 'exact'
+    if cached_content is None and near_cache:
+        context_text = get_fingerprint_context(messages)
+        cached_content = near_cache.lookup(model_id, user_message, context_text,
+                                           st.session_state.near_dup_threshold)
+        cache_source = 'similar'
 
-        if response.status_code == 200:
-            result = response.json()
-            return result['choices'][0]['message']['content'], True
-        elif response.status_code == 401:
-            return "❌ API认证失败，请检查密钥", False
-        elif response.status_code == 404:
-            return f"❌ 模型 {model_id} 不可用", False
-        else:
-            return f"❌ API调用失败: {response.status_code}", False
+    if cached_content is not None:
+        if on_token:
+            on_token(cached_content)
+        st.session_state.last_response_metrics = {
+            'model': model_id,
+            'cache_hit': cache_source,
+            'prompt_tokens': prompt_tokens,
+            'total_time': time.perf_counter() - start,
+        }
+        return cached_content, True, model_id
 
-    except Exception as e:
-        return f"❌ 连接错误: {str(e)[:100]}", False
+    # 并发的相同请求（如重复点击、多个会话同时发同一问题）只发出一次
+    flight_key = ('chat', hash_api_key(api_key),
+                  ResponseCache.make_key(model_id, messages, DEFAULT_TEMPERATURE, MAX_COMPLETION_TOKENS))
+    hedge = st.session_state.hedging_enabled
+    # 按上下文加最大回复长度预约 token，成功后由请求按实际回复长度归还未用完的部分
+    token_cost = prompt_tokens + MAX_COMPLETION_TOKENS
+    (content, success, metrics), shared = get_single_flight().do(
+        flight_key, lambda: send_with_retries(api_key, payload, on_token, hedge=hedge,
+                                              token_cost=token_cost, on_wait=on_wait,
+                                              prompt_tokens=prompt_tokens)
+    )
+    if shared:
+        if on_token and success:
+            on_token(content)
+        if metrics:
+            metrics = dict(metrics, coalesced=True)
+
+    # 对冲请求可能由备用模型回复
+    served_model = metrics.get('served_by', model_id) if success else model_id
+    if success:
+        if content:
+            if cache:
+                cache.put(cache_key, content)
+            if near_cache:
+                near_cache.add(model_id, user_message, context_text, content)
+        st.session_state.last_response_metrics = dict(metrics, model=served_model, prompt_tokens=prompt_tokens,
+                                                      summarized=summary is not None)
+    return content, success, served_model
+
+def measure_rerun(scope):
+    """记录函数（整页或片段）每次运行的耗时，用于对比重跑开销"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                st.session_state.setdefault('rerun_timings', {})[scope] = time.perf_counter() - start
+        return wrapper
+    return decorator
+
+def rerun_after_send(list_changed):
+    """发送后的重跑：新建会话或标题变化时整页重跑以刷新历史面板和侧边栏，否则只重跑对话区"""
+    if list_changed:
+        st.rerun()
+    rerun_fragment()
+
+def rerun_fragment():
+    """片段重跑期间只重跑当前片段；随整页运行时退回整页重跑"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 def render_sidebar():
     """渲染侧边栏"""
     with st.sidebar:
         st.markdown("# 🤖 AI对话控制台")
         
-        # API配置区域
-        st.markdown("### 🔧 API配置")
-        api_key = st.text_input(
-            "GitHub Models API密钥",
-            value=st.session_state.github_api_key,
-            type="password",
-            placeholder="输入您的API密钥..."
-        )
-        
-        if api_key != st.session_state.github_api_key:
-            st.session_state.github_api_key = api_key
-            st.session_state.models_loaded = False
-        
-        # API状态显示
+        render_api_config()
+        st.markdown("---")
+        render_model_picker()
+        st.markdown("---")
+        render_data_management()
+        st.markdown("---")
+        render_usage_stats()
+
+def render_api_config():
+    """渲染API配置区域"""
+    st.markdown("### 🔧 API配置")
+    api_key = st.text_input(
+        "GitHub Models API密钥",
+        value=st.session_state.github_api_key,
+        type="password",
+        placeholder="输入您的API密钥..."
+    )
+
+    if api_key != st.session_state.github_api_key:
+        st.session_state.github_api_key = api_key
+        st.session_state.models_loaded = False
+
+    # API状态显示
+    if st.session_state.github_api_key:
+        st.markdown("""
+        <div class="status-indicator status-connected">
+            <div class="status-dot dot-online"></div>
+            <span>API已连接</span>
+        </div>
+        """, unsafe_allow_html=True)
+    else:
+        st.markdown("""
+        <div class="status-indicator status-disconnected">
+            <div class="status-dot dot-offline"></div>
+            <span>请输入API密钥</span>
+        </div>
+        """, unsafe_allow_html=True)
+
+@st.fragment
+@measure_rerun('模型选择')
+def render_model_picker():
+    """渲染模型选择区域（独立重跑的片段）"""
+    st.markdown("### 🎯 选择AI模型")
+
+    if st.session_state.github_api_key:
+        get_availability_refresher().register(st.session_state.github_api_key)
+
+        # 优先使用共享缓存（包括后台刷新的结果），避免每个会话重复探测
+        if not st.session_state.force_model_probe:
+            cached = load_cached_availability(st.session_state.github_api_key)
+            if cached and (not st.session_state.models_loaded
+                           or cached[1] > st.session_state.model_availability_updated_at):
+                apply_probe_results(*cached)
+                st.session_state.models_loaded = True
+
+    if not st.session_state.models_loaded:
         if st.session_state.github_api_key:
-            st.markdown("""
-            <div class="status-indicator status-connected">
-                <div class="status-dot dot-online"></div>
-                <span>API已连接</span>
-            </div>
-            """, unsafe_allow_html=True)
+            with st.spinner("检测可用模型..."):
+                all_models = get_routable_models()
+
+                # 并发测试模型可用性，结果到达即更新对应的占位卡片
+                status_placeholders = {model['id']: st.empty() for model in all_models}
+                for model in all_models:
+                    status_placeholders[model['id']].caption(format_probe_status(model, None))
+
+                def show_probe_result(model, result):
+                    status_placeholders[model['id']].caption(format_probe_status(model, result))
+
+                probe_results = probe_models_concurrently(
+                    st.session_state.github_api_key, all_models, on_result=show_probe_result
+                )
+                store_cached_availability(st.session_state.github_api_key, probe_results)
+                apply_probe_results(probe_results, time.time())
+                st.session_state.force_model_probe = False
+                st.session_state.models_loaded = True
+                st.rerun()
         else:
+            st.session_state.available_models = get_all_supported_models()
+            st.session_state.models_loaded = True
+
+    # 显示当前选择的模型
+    current_model = next((m for m in st.session_state.available_models 
+                        if m['id'] == st.session_state.selected_model), None)
+    if current_model:
+        st.info(f"当前模型：**{current_model['name']}**")
+
+    # 智能路由档位
+    if st.session_state.selected_model == AUTO_MODEL_ID:
+        tiers = list(ROUTING_TIERS)
+        st.session_state.routing_tier = st.radio(
+            "路由档位",
+            tiers,
+            index=tiers.index(st.session_state.routing_tier),
+            horizontal=True,
+            help="在该档位的候选模型中，自动选择最近延迟低、错误少的模型"
+        )
+        last_route = st.session_state.last_route
+        if last_route:
+            routed = get_model_info(last_route['model'])
+            st.caption(f"上次路由：{routed['name'] if routed else last_route['model']}（{last_route['reason']}）")
+
+    # 模型列表
+    for model in st.session_state.available_models:
+        is_selected = model['id'] == st.session_state.selected_model
+
+        # 构建标签
+        tags_html = ""
+        for tag in model['tags']:
+            tag_class = ""
+            if tag in ['最新', '高质量', '多模态']:
+                tag_class = "premium"
+            elif tag in ['快速', '经济', '轻量']:
+                tag_class = "fast"
+            elif tag in ['推荐']:
+                tag_class = "recommended"
+
+            tags_html += f'<span class="model-tag {tag_class}">{tag}</span>'
+
+        # 探测延迟
+        probe_result = st.session_state.model_probe_results.get(model['id'])
+        if probe_result and probe_result['latency'] is not None:
+            tags_html += f'<span class="model-tag">⏱ {int(probe_result["latency"] * 1000)} ms</span>'
+
+        # 熔断状态
+        breaker_state, breaker_remaining = get_circuit_breakers().get(model['id']).snapshot()
+        if breaker_state == 'open':
+            tags_html += f'<span class="model-tag premium">🔴 熔断中 {int(breaker_remaining)}s</span>'
+        elif breaker_state == 'half_open':
+            tags_html += '<span class="model-tag premium">🟡 恢复试探中</span>'
+
+        # 模型卡片
+        card_class = "model-card selected" if is_selected else "model-card"
+        st.markdown(f"""
+        <div class="{card_class}">
+            <div class="model-name">{model['name']}</div>
+            <div class="model-description">{model['description']}</div>
+            <div class="model-tags">{tags_html}</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+        # 选择按钮
+        button_text = "✓ 已选择" if is_selected else f"选择 {model['name']}"
+        if st.button(
+            button_text,
+            key=f"select_{model['id']}",
+            disabled=is_selected,
+            use_container_width=True
+        ):
+            st.session_state.selected_model = model['id']
+            st.success(f"✅ 已切换到 {model['name']}")
+            save_chat_data()
+            st.rerun()
+
+def render_data_management():
+    """渲染数据管理区域"""
+    st.markdown("### 💾 数据管理")
+
+    # 存储状态
+    if st.session_state.chat_messages:
+        message_count = len(st.session_state.chat_messages)
+        st.markdown(f"📊 聊天记录：{message_count} 条")
+
+    # 自动保存开关
+    auto_save = st.checkbox(
+        "🔄 自动保存",
+        value=st.session_state.get('auto_save_enabled', True),
+        help="每次对话后自动保存到浏览器"
+    )
+    st.session_state.auto_save_enabled = auto_save
+
+    # 流式输出开关
+    st.session_state.stream_enabled = st.checkbox(
+        "⚡ 流式输出",
+        value=st.session_state.stream_enabled,
+        help="边生成边显示回复，减少等待时间"
+    )
+
+    # 请求对冲开关
+    st.session_state.hedging_enabled = st.checkbox(
+        "🛡️ 请求对冲",
+        value=st.session_state.hedging_enabled,
+        help="主请求超过该模型近期 p95 延迟仍未出首字时，再发一份请求，先返回者胜出（会增加少量请求）"
+    )
+
+    # 响应缓存开关
+    st.session_state.response_cache_enabled = st.checkbox(
+        "🧠 响应缓存",
+        value=st.session_state.response_cache_enabled,
+        help="完全相同的问题和上下文直接返回之前的回复，不再调用模型"
+    )
+
+    # 相似问题缓存开关
+    st.session_state.near_dup_cache_enabled = st.checkbox(
+        "🔍 相似问题缓存",
+        value=st.session_state.near_dup_cache_enabled,
+        help="只有标点、空格或个别字不同的问题复用之前的回复"
+    )
+    if st.session_state.near_dup_cache_enabled:
+        st.session_state.near_dup_threshold = st.slider(
+            "相似度阈值",
+            min_value=0.5,
+            max_value=1.0,
+            value=st.session_state.near_dup_threshold,
+            step=0.05
+        )
+
+    # 数据操作按钮
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 手动保存", use_container_width=True):
+            save_chat_data(force=True)
+            st.success("已保存到本地")
+
+    with col2:
+        if st.button("🗑️ 清空记录", use_container_width=True):
+            if get_session_owner() and st.session_state.current_session_id:
+                store_clear_messages(get_session_owner(), st.session_state.current_session_id)
+            reset_session_entry(st.session_state.current_session_id)
+            st.session_state.earlier_messages_cursor = None
+            st.session_state.conversation_count = 0
+            st.session_state.persisted_chat_state = None
+            # 清空本地存储
             st.markdown("""
-            <div class="status-indicator status-disconnected">
-                <div class="status-dot dot-offline"></div>
-                <span>请输入API密钥</span>
-            </div>
-            """, unsafe_allow_html=True)
-        
-        st.markdown("---")
-        
-        # 模型选择区域
-        st.markdown("### 🎯 选择AI模型")
-        
-        if not st.session_state.models_loaded:
-            if st.session_state.github_api_key:
-                with st.spinner("检测可用模型..."):
-                    all_models = get_all_supported_models()
-                    available_models = []
-                    
-                    # 测试模型可用性
-                    for model in all_models:
-                        if test_model_availability(st.session_state.github_api_key, model['id']):
-                            available_models.append(model)
-                    
-                    st.session_state.available_models = available_models if available_models else all_models
-                    st.session_state.models_loaded = True
-                    st.rerun()
-            else:
-                st.session_state.available_models = get_all_supported_models()
-                st.session_state.models_loaded = True
-        
-        # 显示当前选择的模型
-        current_model = next((m for m in st.session_state.available_models 
-                            if m['id'] == st.session_state.selected_model), None)
-        if current_model:
-            st.info(f"当前模型：**{current_model['name']}**")
-        
-        # 模型列表
-        for model in st.session_state.available_models:
-            is_selected = model['id'] == st.session_state.selected_model
-            
-            # 构建标签
-            tags_html = ""
-            for tag in model['tags']:
-                tag_class = ""
-                if tag in ['最新', '高质量', '多模态']:
-                    tag_class = "premium"
-                elif tag in ['快速', '经济', '轻量']:
-                    tag_class = "fast"
-                elif tag in ['推荐']:
-                    tag_class = "recommended"
-                
-                tags_html += f'<span class="model-tag {tag_class}">{tag}</span>'
-            
-            # 模型卡片
-            card_class = "model-card selected" if is_selected else "model-card"
-            st.markdown(f"""
-            <div class="{card_class}">
-                <div class="model-name">{model['name']}</div>
-                <div class="model-description">{model['description']}</div>
-                <div class="model-tags">{tags_html}</div>
-            </div>
+            <script>
+            localStorage.removeItem('ai_chat_complete_data');
+            localStorage.removeItem('ai_chat_log');
+            localStorage.removeItem('ai_chat_data');
+            console.log('🗑️ 本地存储已清空');
+            </script>
             """, unsafe_allow_html=True)
+            st.success("记录已清空")
+            st.rerun()
 
-            # 选择按钮
-            button_text = "✓ 已选择" if is_selected else f"选择 {model['name']}"
-            if st.button(
-                button_text,
-                key=f"select_{model['id']}",
-                disabled=is_selected,
-                use_container_width=True
-            ):
-                st.session_state.selected_model = model['id']
-                st.success(f"✅ 已切换到 {model['name']}")
-                save_chat_data()
-                st.rerun()
-        
-        st.markdown("---")
-        
-        # 数据管理区域
-        st.markdown("### 💾 数据管理")
-        
-        # 存储状态
-        if st.session_state.chat_messages:
-            message_count = len(st.session_state.chat_messages)
-            st.markdown(f"📊 聊天记录：{message_count} 条")
-        
-        # 自动保存开关
-        auto_save = st.checkbox(
-            "🔄 自动保存",
-            value=st.session_state.get('auto_save_enabled', True),
-            help="每次对话后自动保存到浏览器"
+    # 导出功能
+    if st.session_state.chat_messages:
+        export_data = {
+            'export_time': datetime.now().isoformat(),
+            'model_used': st.session_state.selected_model,
+            'message_count': len(st.session_state.chat_messages),
+            'messages': st.session_state.chat_messages
+        }
+
+        st.download_button(
+            "📤 导出JSON",
+            json.dumps(export_data, ensure_ascii=False, indent=2, default=json_default),
+            file_name=f"ai_chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json",
+            use_container_width=True
         )
-        st.session_state.auto_save_enabled = auto_save
-        
-        # 数据操作按钮
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("💾 手动保存", use_container_width=True):
-                save_chat_data()
-                st.success("已保存到本地")
-        
-        with col2:
-            if st.button("🗑️ 清空记录", use_container_width=True):
-                st.session_state.chat_messages = []
-                st.session_state.conversation_count = 0
-                # 清空本地存储
-                st.markdown("""
-                <script>
-                localStorage.removeItem('ai_chat_complete_data');
-                localStorage.removeItem('ai_chat_data');
-                console.log('🗑️ 本地存储已清空');
-                </script>
-                """, unsafe_allow_html=True)
-                st.success("记录已清空")
-                st.rerun()
-        
-        # 导出功能
-        if st.session_state.chat_messages:
-            export_data = {
-                'export_time': datetime.now().isoformat(),
-                'model_used': st.session_state.selected_model,
-                'message_count': len(st.session_state.chat_messages),
-                'messages': st.session_state.chat_messages
-            }
-            
-            st.download_button(
-                "📤 导出JSON",
-                json.dumps(export_data, ensure_ascii=False, indent=2),
-                file_name=f"ai_chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                mime="application/json",
-                use_container_width=True
-            )
-        
-        st.markdown("---")
-        
-        # 统计信息
-        st.markdown("### 📊 使用统计")
-        st.markdown(f"对话轮数：{st.session_state.conversation_count}")
-        st.markdown(f"当前用户：Kikyo-acd")
-        st.markdown(f"时间：2025-08-08 10:16:29")
+
+@st.fragment(run_every=STATS_REFRESH_SECONDS)
+@measure_rerun('使用统计')
+def render_usage_stats():
+    """渲染使用统计（定时刷新的片段）"""
+    st.markdown("### 📊 使用统计")
+    st.markdown(f"对话轮数：{st.session_state.conversation_count}")
+    metrics = st.session_state.last_response_metrics
+    if metrics:
+        if metrics.get('cache_hit') == 'exact':
+            st.markdown("上次回复来自响应缓存")
+        elif metrics.get('cache_hit') == 'similar':
+            st.markdown("上次回复来自相似问题缓存")
+        elif metrics.get('coalesced'):
+            st.markdown("上次回复与同时进行的相同请求合并")
+        if metrics.get('time_to_first_token') is not None:
+            speed = metrics.get('tokens_per_second') or 0
+            st.markdown(f"首字延迟：{metrics['time_to_first_token']:.2f} 秒 · {speed:.1f} tokens/秒")
+        st.markdown(f"上次响应耗时：{metrics['total_time']:.2f} 秒")
+        st.markdown(f"上下文大小：{metrics['prompt_tokens']} tokens"
+                    + ("（含历史摘要）" if metrics.get('summarized') else ""))
+    cache_stats = get_response_cache().stats()
+    st.markdown(f"响应缓存：命中 {cache_stats['hits']} 次（内存 {cache_stats['memory_hits']} · "
+                f"磁盘 {cache_stats['disk_hits']}）· 未命中 {cache_stats['misses']} 次")
+    duplicate_count = st.session_state.duplicate_submits
+    coalesced_count = get_single_flight().coalesced
+    if duplicate_count or coalesced_count:
+        st.markdown(f"重复提交拦截 {duplicate_count} 次 · 合并相同请求 {coalesced_count} 次")
+    limiter_stats = get_rate_limiter().stats()
+    if limiter_stats['queued'] or limiter_stats['rejected']:
+        st.markdown(f"限流排队：{limiter_stats['queued']}/{limiter_stats['reservations']} 次请求 · "
+                    f"平均等待 {limiter_stats['avg_wait']:.1f} 秒 · 排队过长 {limiter_stats['rejected']} 次")
+    hedge_stats = get_hedge_stats().stats()
+    if hedge_stats['hedges_sent']:
+        st.markdown(f"请求对冲：额外请求 {hedge_stats['hedges_sent']}/{hedge_stats['requests']}"
+                    f"（+{hedge_stats['overhead']:.0%}）· 对冲胜出 {hedge_stats['hedge_wins']} 次 · "
+                    f"共节省 {hedge_stats['time_saved']:.1f} 秒")
+    near_stats = get_near_duplicate_cache().stats()
+    st.markdown(f"相似问题缓存：命中率 {near_stats['hit_rate']:.0%}（{near_stats['hits']}/{near_stats['lookups']}）· "
+                f"平均查找 {near_stats['avg_lookup_ms']:.1f} ms")
+    http_stats = get_http_client().stats()
+    protocol = "HTTP/2" if http_stats['http2'] else "HTTP/1.1"
+    backend_stats = get_http_client().backends.snapshot()
+    if len(backend_stats) > 1:
+        st.markdown("后端：" + " · ".join(
+            f"{b['name']} {'🟢' if b['healthy'] else '🔴'} 在途 {b['outstanding']}（{b['errors']}/{b['requests']} 失败）"
+            for b in backend_stats
+        ))
+    st.markdown(f"连接复用：{http_stats['reused']}/{http_stats['requests']} 次请求 · "
+                f"{http_stats['connections']} 个连接 ({protocol}) · "
+                f"在途 {http_stats['in_flight']}（峰值 {http_stats['peak_in_flight']}）")
+    rerun_timings = st.session_state.get('rerun_timings', {})
+    if rerun_timings:
+        st.markdown("重跑耗时：" + " · ".join(
+            f"{scope} {duration * 1000:.0f} ms" for scope, duration in rerun_timings.items()
+        ))
+    render_latency_dashboard()
+    st.markdown(f"当前用户：Kikyo-acd")
+    st.markdown(f"时间：2025-08-08 10:16:29")
+
+def summarize_telemetry(records):
+    """按模型汇总对话调用的延迟分位数和生成速度"""
+    frame = pd.DataFrame([r for r in records if r['kind'] == 'chat'])
+    if frame.empty:
+        return frame
+    # 全为 None 的列是 object 类型，pandas 3 不支持对其求分位数，先统一转为数值
+    for column in ('ttft', 'total_time', 'tokens_per_second'):
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    frame['latency'] = frame['ttft'].fillna(frame['total_time'])
+    grouped = frame.groupby('model')
+    summary = grouped['latency'].quantile([0.5, 0.95, 0.99]).unstack()
+    summary.columns = ['p50', 'p95', 'p99']
+    summary['tokens/s'] = grouped['tokens_per_second'].median()
+    summary['calls'] = grouped.size()
+    summary['errors'] = grouped['status'].apply(lambda s: int((s != 200).sum()))
+    return summary.reset_index()
+
+def render_latency_dashboard():
+    """按模型展示调用延迟分位数和生成速度
+
+    所在的统计片段会定时重跑，因此只在用户打开开关后才汇总和绘图，没有新调用时复用上次的汇总。
+    """
+    telemetry = get_http_client().telemetry
+    if not telemetry.sequence or not st.toggle("📈 调用延迟", key='show_latency_dashboard'):
+        return
+
+    sequence = telemetry.sequence
+    cached = st.session_state.latency_summary
+    if cached is None or cached[0] != sequence:
+        cached = (sequence, summarize_telemetry(telemetry.snapshot()))
+        st.session_state.latency_summary = cached
+    summary = cached[1]
+    if summary.empty:
+        return
+
+    latency_frame = summary.melt(id_vars='model', value_vars=['p50', 'p95', 'p99'],
+                                 var_name='分位数', value_name='秒')
+    fig = px.bar(latency_frame, x='model', y='秒', color='分位数', barmode='group',
+                 title="首字延迟（非流式为总耗时）")
+    fig.update_layout(height=280, margin=dict(l=0, r=0, t=30, b=0), xaxis_title=None)
+    st.plotly_chart(fig, use_container_width=True)
+
+    speed_frame = summary.dropna(subset=['tokens/s'])
+    if not speed_frame.empty:
+        fig = px.bar(speed_frame, x='model', y='tokens/s', title="生成速度（中位数）")
+        fig.update_layout(height=240, margin=dict(l=0, r=0, t=30, b=0), xaxis_title=None)
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.dataframe(summary.round(2), hide_index=True, use_container_width=True)
 
 def render_main_content():
     """渲染主要内容区域"""
@@ -951,31 +3771,62 @@ def render_main_content():
     with chat_history_col:
         render_chat_history_panel()
 
+def get_message_html(msg):
+    """生成单条消息的HTML，已渲染过的消息直接从缓存读取"""
+    cache = st.session_state.message_html_cache
+    cache_key = msg.get('id') or (msg['role'], msg.get('timestamp'), len(msg['content']))
+    html = cache.get(cache_key)
+    if html is not None:
+        cache.move_to_end(cache_key)
+        return html
+
+    timestamp = time.strftime("%H:%M", time.localtime(msg.get('timestamp', time.time())))
+    model_used = msg.get('model', '未知模型')
+    
+    if msg['role'] == 'user':
+        html = f"""
+        <div class="user-message">
+            {msg['content']}
+            <div class="message-time">{timestamp}</div>
+        </div>
+        """
+    else:
+        html = f"""
+        <div class="ai-message">
+            <div class="message-model">🤖 {model_used}</div>
+            {msg['content']}
+            <div class="message-time">{timestamp}</div>
+        </div>
+        """
+
+    cache[cache_key] = html
+    if len(cache) > MESSAGE_HTML_CACHE_SIZE:
+        cache.popitem(last=False)
+    return html
+
+@st.fragment
+@measure_rerun('对话区')
 def render_main_chat_area():
-    """渲染主要聊天区域"""
+    """渲染主要聊天区域（独立重跑的片段）"""
     # 聊天历史显示
     if st.session_state.chat_messages:
         st.markdown("### 💬 对话记录")
         
-        for msg in st.session_state.chat_messages:
-            timestamp = time.strftime("%H:%M", time.localtime(msg.get('timestamp', time.time())))
-            model_used = msg.get('model', '未知模型')
-            
-            if msg['role'] == 'user':
-                st.markdown(f"""
-                <div class="user-message">
-                    {msg['content']}
-                    <div class="message-time">{timestamp}</div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="ai-message">
-                    <div class="message-model">🤖 {model_used}</div>
-                    {msg['content']}
-                    <div class="message-time">{timestamp}</div>
-                </div>
-                """, unsafe_allow_html=True)
+        # 只渲染最近的消息窗口，更早的消息按页展开
+        messages = st.session_state.chat_messages
+        window = st.session_state.render_window
+        if window < len(messages) or st.session_state.earlier_messages_cursor is not None:
+            hidden_count = max(0, len(messages) - window)
+            label = f"⬆️ 加载更早的消息（已隐藏 {hidden_count} 条）" if hidden_count else "⬆️ 加载更早的消息"
+            if st.button(label, key="load_earlier_messages"):
+                if window >= len(messages):
+                    # 内存中的消息已全部显示，从服务端存储读取更早的一页
+                    load_earlier_messages()
+                st.session_state.render_window = window + RENDER_PAGE_MESSAGES
+                rerun_fragment()
+        
+        for msg in messages[-window:]:
+            st.markdown(get_message_html(msg), unsafe_allow_html=True)
     
     # 输入区域
     st.markdown("### ✨ 开始对话")
@@ -995,20 +3846,26 @@ def render_main_chat_area():
     )
 
     col1, col2, col3 = st.columns([3, 1, 1])
-    
+
+    # 提交令牌随按钮一起渲染，已被接受的令牌再次提交会被丢弃
+    submit_token = st.session_state.submit_token or new_submit_token()
+
     with col1:
         send_disabled = not st.session_state.github_api_key
-        if st.button("🚀 发送消息", use_container_width=True, type="primary", disabled=send_disabled):
+        if st.button("🚀 发送消息", use_container_width=True, type="primary", disabled=send_disabled,
+                     on_click=accept_submit, args=(submit_token,)) and consume_submit(submit_token):
+            new_submit_token()
             if not st.session_state.github_api_key:
                 st.error("请在侧边栏配置API密钥")
             elif user_input.strip():
-                process_chat_message(user_input.strip())
-                st.rerun()
+                rerun_after_send(process_chat_message(user_input.strip()))
             else:
                 st.warning("请输入内容")
 
     with col2:
-        if st.button("🎲 随机话题", use_container_width=True, disabled=send_disabled):
+        if st.button("🎲 随机话题", use_container_width=True, disabled=send_disabled,
+                     on_click=accept_submit, args=(submit_token,)) and consume_submit(submit_token):
+            new_submit_token()
             if st.session_state.github_api_key:
                 topics = [
                     "给我讲一个有趣的科学事实",
@@ -1018,53 +3875,73 @@ def render_main_chat_area():
                     "分析一下当前的科技趋势"
                 ]
                 random_topic = random.choice(topics)
-                process_chat_message(random_topic)
+                rerun_after_send(process_chat_message(random_topic))
             else:
                 st.error("请先配置API密钥")
 
     with col3:
         if st.button("🔄 刷新模型", use_container_width=True):
             st.session_state.models_loaded = False
+            st.session_state.force_model_probe = True
             st.rerun()
 
+    # 片段单独重跑时不会执行 main()，在这里写入本片段产生的变更
+    flush_chat_data()
+
+def change_session_page(delta):
+    """翻页按钮回调；delta 为 None 时（筛选条件变化）回到第一页"""
+    if delta is None:
+        st.session_state.session_page = 0
+    else:
+        st.session_state.session_page = max(st.session_state.session_page + delta, 0)
+
+@st.fragment
+@measure_rerun('历史会话')
 def render_chat_history_panel():
-    """渲染聊天记录选择面板"""
+    """渲染聊天记录选择面板（独立重跑的片段）"""
     st.markdown("### 📚 聊天记录")
     
     # 新建会话按钮
     if st.button("➕ 新建对话", use_container_width=True, type="primary"):
         # 保存当前会话
-        if st.session_state.current_session_id and st.session_state.chat_messages:
-            st.session_state.chat_sessions[st.session_state.current_session_id] = {
-                'messages': st.session_state.chat_messages.copy(),
-                'created_time': datetime.now(),
-                'message_count': len(st.session_state.chat_messages),
-                'title': get_session_title(st.session_state.chat_messages)
-            }
+        stash_current_session()
         
         # 创建新会话
-        st.session_state.session_counter += 1
-        new_session_id = f"session_{st.session_state.session_counter}_{int(time.time())}"
-        st.session_state.current_session_id = new_session_id
+        st.session_state.current_session_id = None
+        ensure_current_session()
         st.session_state.chat_messages = []
+        st.session_state.earlier_messages_cursor = None
+        st.session_state.render_window = RENDER_WINDOW_MESSAGES
         st.session_state.conversation_count = 0
         save_chat_data()
         st.rerun()
     
     st.markdown("---")
     
-    # 显示会话列表
-    if st.session_state.chat_sessions:
+    # 显示会话列表（按索引分页，只渲染当前页）
+    session_index = st.session_state.session_index
+    if len(session_index):
         st.markdown("**历史会话：**")
-        
-        # 按创建时间排序显示会话
-        sorted_sessions = sorted(
-            st.session_state.chat_sessions.items(),
-            key=lambda x: x[1]['created_time'],
-            reverse=True
-        )
-        
-        for session_id, session_data in sorted_sessions:
+
+        query = st.text_input("筛选会话", key="session_filter", placeholder="🔍 按标题筛选",
+                              label_visibility="collapsed", on_change=change_session_page, args=(None,))
+        match = None
+        if query.strip():
+            needle = query.strip().lower()
+            sessions = st.session_state.chat_sessions
+            match = lambda session_id: needle in sessions[session_id]['title'].lower()
+
+        page_ids, has_more = session_index.page(st.session_state.session_page * SESSION_PAGE_SIZE,
+                                                SESSION_PAGE_SIZE, match)
+        if not page_ids and st.session_state.session_page > 0:
+            # 删除会话后当前页可能已空，回到第一页
+            st.session_state.session_page = 0
+            page_ids, has_more = session_index.page(0, SESSION_PAGE_SIZE, match)
+        if not page_ids:
+            st.caption("没有匹配的会话")
+
+        for session_id in page_ids:
+            session_data = st.session_state.chat_sessions[session_id]
             is_current = session_id == st.session_state.current_session_id
             
             # 会话信息
@@ -1091,50 +3968,66 @@ def render_chat_history_panel():
             with col1:
                 if not is_current:
                     if st.button(f"切换", key=f"switch_{session_id}", use_container_width=True):
-                        # 保存当前会话
-                        if st.session_state.current_session_id and st.session_state.chat_messages:
-                            st.session_state.chat_sessions[st.session_state.current_session_id] = {
-                                'messages': st.session_state.chat_messages.copy(),
-                                'created_time': st.session_state.chat_sessions.get(st.session_state.current_session_id, {}).get('created_time', datetime.now()),
-                                'message_count': len(st.session_state.chat_messages),
-                                'title': get_session_title(st.session_state.chat_messages)
-                            }
-                        
-                        # 切换到选择的会话
-                        st.session_state.current_session_id = session_id
-                        st.session_state.chat_messages = session_data['messages'].copy()
-                        st.session_state.conversation_count = len([m for m in session_data['messages'] if m['role'] == 'user'])
+                        # 保存当前会话并切换到选择的会话
+                        open_session(session_id)
                         save_chat_data()
                         st.rerun()
                 else:
                     st.markdown("**当前**")
             
             with col2:
-                # 导出单个会话
-                export_data = {
-                    'session_id': session_id,
-                    'title': title,
-                    'created_time': created_time,
-                    'messages': session_data['messages']
-                }
-                st.download_button(
-                    "📤",
-                    json.dumps(export_data, ensure_ascii=False, indent=2),
-                    file_name=f"chat_session_{created_time.replace(':', '-')}.json",
-                    mime="application/json",
-                    key=f"export_{session_id}",
-                    help="导出此会话"
-                )
+                # 导出单个会话（服务端存储的会话在点击后才读取消息）
+                if session_data['messages'] is None and st.session_state.pending_export_session != session_id:
+                    if st.button("📤", key=f"prepare_export_{session_id}", help="导出此会话"):
+                        st.session_state.pending_export_session = session_id
+                        rerun_fragment()
+                else:
+                    export_data = {
+                        'session_id': session_id,
+                        'title': title,
+                        'created_time': created_time,
+                        'messages': load_full_session_messages(session_id)
+                    }
+                    st.download_button(
+                        "📤",
+                        json.dumps(export_data, ensure_ascii=False, indent=2, default=json_default),
+                        file_name=f"chat_session_{created_time.replace(':', '-')}.json",
+                        mime="application/json",
+                        key=f"export_{session_id}",
+                        help="导出此会话"
+                    )
             
             with col3:
                 if st.button("🗑️", key=f"delete_{session_id}", help="删除此会话"):
                     del st.session_state.chat_sessions[session_id]
+                    st.session_state.session_index.remove(session_id)
+                    st.session_state.session_views.pop(session_id, None)
+                    if get_session_owner():
+                        store_delete_sessions(get_session_owner(), [session_id])
+                    save_chat_data()
                     if session_id == st.session_state.current_session_id:
                         st.session_state.current_session_id = None
                         st.session_state.chat_messages = []
+                        st.session_state.earlier_messages_cursor = None
                         st.session_state.conversation_count = 0
-                    save_chat_data()
-                    st.rerun()
+                        st.rerun()
+                    # 删除其他会话不影响对话区，只重跑本面板
+                    rerun_fragment()
+
+        if st.session_state.session_page > 0 or has_more:
+            col_prev, col_page, col_next = st.columns([1, 1, 1])
+            with col_prev:
+                st.button("◀", key="session_page_prev", help="上一页", use_container_width=True,
+                          disabled=st.session_state.session_page == 0,
+                          on_click=change_session_page, args=(-1,))
+            with col_page:
+                st.markdown(
+                    f"<div style='text-align: center; color: #64748b;'>第 {st.session_state.session_page + 1} 页</div>",
+                    unsafe_allow_html=True
+                )
+            with col_next:
+                st.button("▶", key="session_page_next", help="下一页", use_container_width=True,
+                          disabled=not has_more, on_click=change_session_page, args=(1,))
     
     else:
         st.info("暂无历史会话")
@@ -1152,11 +4045,14 @@ def render_chat_history_panel():
                     'export_time': datetime.now().isoformat(),
                     'user': 'Kikyo-acd',
                     'session_count': len(st.session_state.chat_sessions),
-                    'sessions': st.session_state.chat_sessions
+                    'sessions': {
+                        session_id: dict(session_data, messages=load_full_session_messages(session_id))
+                        for session_id, session_data in st.session_state.chat_sessions.items()
+                    }
                 }
                 st.download_button(
                     "下载全部会话",
-                    json.dumps(all_sessions_data, ensure_ascii=False, indent=2),
+                    json.dumps(all_sessions_data, ensure_ascii=False, indent=2, default=json_default),
                     file_name=f"all_chat_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                     mime="application/json"
                 )
@@ -1164,13 +4060,24 @@ def render_chat_history_panel():
         with col2:
             if st.button("🗑️ 清空全部", use_container_width=True):
                 if st.checkbox("确认清空所有会话", key="confirm_clear_all"):
+                    if get_session_owner():
+                        store_delete_sessions(get_session_owner(),
+                                              list(st.session_state.chat_sessions)
+                                              + [st.session_state.current_session_id])
                     st.session_state.chat_sessions = {}
+                    st.session_state.session_index = SessionIndex()
+                    st.session_state.session_page = 0
+                    st.session_state.session_views.clear()
                     st.session_state.current_session_id = None
                     st.session_state.chat_messages = []
+                    st.session_state.earlier_messages_cursor = None
                     st.session_state.conversation_count = 0
                     save_chat_data()
                     st.rerun()
 
+    # 片段单独重跑时不会执行 main()，在这里写入本片段产生的变更
+    flush_chat_data()
+
 def get_session_title(messages):
     """根据聊天消息生成会话标题"""
     if not messages:
@@ -1186,21 +4093,38 @@ def get_session_title(messages):
     
     return f"对话 - {datetime.now().strftime('%H:%M')}"
 
+def new_submit_token():
+    """为当前渲染的输入区生成新的提交令牌"""
+    st.session_state.submit_token = os.urandom(8).hex()
+    return st.session_state.submit_token
+
+def accept_submit(token):
+    """按钮回调：每个令牌只接受一次提交，快速重复点击带着同一令牌，会被识别并丢弃"""
+    if token in st.session_state.used_submit_tokens:
+        st.session_state.accepted_submit = None
+        st.session_state.duplicate_submits += 1
+        return
+    st.session_state.used_submit_tokens.append(token)
+    st.session_state.accepted_submit = token
+
+def consume_submit(token):
+    """判断本次点击是否是该令牌第一次被接受的提交"""
+    if st.session_state.accepted_submit != token:
+        return False
+    st.session_state.accepted_submit = None
+    return True
+
 def process_chat_message(user_message):
-    """处理聊天消息"""
+    """处理聊天消息，返回会话列表是否需要刷新"""
     # 添加用户消息
-    st.session_state.chat_messages.append({
-        'role': 'user',
-        'content': user_message,
-        'timestamp': time.time(),
-        'model': st.session_state.selected_model
-    })
+    user_entry = ChatMessage(MessageRole.USER, user_message, model=st.session_state.selected_model)
+    st.session_state.chat_messages.append(user_entry)
 
     # 显示思考动画
     thinking_placeholder = st.empty()
-    current_model_name = next((m['name'] for m in st.session_state.available_models 
-                             if m['id'] == st.session_state.selected_model), 
-                            st.session_state.selected_model)
+    model_id = resolve_model(st.session_state.selected_model)
+    current_model_name = next((m['name'] for m in get_all_supported_models()
+                             if m['id'] == model_id), model_id)
     
     with thinking_placeholder:
         st.markdown(f"""
@@ -1214,20 +4138,44 @@ def process_chat_message(user_message):
         </div>
         """, unsafe_allow_html=True)
 
-    # 获取AI响应
-    ai_response, success = call_ai_api(
-        user_message, st.session_state.selected_model, st.session_state.github_api_key
+    # 获取AI响应（流式模式下逐段渲染到占位符中）
+    on_token = None
+    if st.session_state.stream_enabled:
+        last_render = [0.0]
+
+        def on_token(partial_content):
+            # 限制刷新频率，避免每个token都推送一次前端更新
+            now = time.perf_counter()
+            if now - last_render[0] < 0.05:
+                return
+            last_render[0] = now
+            thinking_placeholder.markdown(f"""
+            <div class="ai-message">
+                <div class="message-model">🤖 {current_model_name}</div>
+                {partial_content}▌
+            </div>
+            """, unsafe_allow_html=True)
+
+    def on_wait(wait_seconds):
+        thinking_placeholder.info(f"⏳ 当前请求较多，已进入排队，预计等待 {wait_seconds:.0f} 秒")
+
+    ai_response, success, served_model = call_ai_api(
+        user_message, model_id, st.session_state.github_api_key,
+        on_token=on_token, on_wait=on_wait
     )
 
     thinking_placeholder.empty()
+    if served_model != model_id:
+        # 对冲时由备用模型回复，按实际模型标注
+        current_model_name = next((m['name'] for m in get_all_supported_models()
+                                   if m['id'] == served_model), served_model)
 
     # 添加AI响应
-    st.session_state.chat_messages.append({
-        'role': 'assistant',
-        'content': ai_response,
-        'timestamp': time.time(),
-        'model': current_model_name
-    })
+    ai_entry = ChatMessage(MessageRole.ASSISTANT, ai_response, model=current_model_name)
+    st.session_state.chat_messages.append(ai_entry)
+
+    # 写入服务端会话存储
+    list_changed = record_new_messages([user_entry, ai_entry])
 
     # 更新统计
     st.session_state.conversation_count += 1
@@ -1239,6 +4187,7 @@ def process_chat_message(user_message):
         st.success(f"✅ {current_model_name} 回复已生成并保存")
     else:
         st.error(f"❌ {current_model_name} 生成失败")
+    return list_changed
 
 
 
@@ -1247,10 +4196,11 @@ def show_restore_interface():
     # 创建一个简单的检查界面
     st.markdown("""
     <script>
+    """ + CHAT_LOG_REPLAY_JS + """
     // 检查本地存储并显示按钮
     (function() {
         try {
-            const completeData = localStorage.getItem('ai_chat_complete_data');
+            const completeData = loadChatData();
             const oldData = localStorage.getItem('ai_chat_data');
             
             let messageCount = 0;
@@ -1417,6 +4367,7 @@ def show_restore_interface():
                 document.getElementById('restore-no-btn').onclick = function() {
                     if (confirm('确认要清空所有本地聊天记录吗？此操作不可撤销。')) {
                         localStorage.removeItem('ai_chat_complete_data');
+                        localStorage.removeItem('ai_chat_log');
                         localStorage.removeItem('ai_chat_data');
                         
                         // 显示清空成功
@@ -1523,6 +4474,7 @@ def apply_restored_data_simple():
     """, unsafe_allow_html=True)
 
 # 修改 main() 函数
+@measure_rerun('整页')
 def main():
     """主程序"""
     # 应用样式
@@ -1539,7 +4491,11 @@ def main():
     
     # 渲染界面
     render_sidebar()
+    load_session_index()
     render_main_content()
+    
+    # 合并写入本次运行中的所有保存请求
+    flush_chat_data()
 
 if __name__ == "__main__":
     main()
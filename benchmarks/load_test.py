@@ -0,0 +1,368 @@
+"""多用户并发压测：模拟 N 个浏览器会话同时与运行中的应用对话
+
+默认启动本地模拟模型服务，并以子进程方式运行 `streamlit run app.py` 指向它；
+每个虚拟用户通过 Streamlit 的 WebSocket 协议连接应用，输入API密钥后按随机的思考时间
+和消息长度连续发送消息。结束时报告吞吐量、应用层与模型层的延迟分位数、错误率和服务进程内存。
+
+    python benchmarks/load_test.py --users 20 --messages 5 --model-latency 0.5
+    python benchmarks/load_test.py --app-url http://127.0.0.1:8501 --app-pid 12345 --mock-port 8765
+
+使用已运行的应用时，需要让它的 MODEL_API_URL 指向 --mock-port 上的模拟服务，才能得到模型层数据。
+压测额外依赖 websockets：`pip install -r benchmarks/requirements.txt`。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'app.py')
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import MockConfig, MockServer  # noqa: E402
+
+try:
+    import websockets
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+except ImportError as e:
+    sys.exit(f"缺少依赖：{e.name}。请先安装压测依赖：pip install -r benchmarks/requirements.txt")
+
+API_KEY_LABEL = "GitHub Models API密钥"
+CHAT_INPUT_KEY = "chat_input"
+SEND_BUTTON_LABEL = "发送消息"
+FAILED_REPLY_MARK = "生成失败"
+WORDS = ["如何", "解释", "一下", "机器学习", "的", "原理", "并", "举例", "说明", "Python", "代码",
+         "性能", "优化", "有哪些", "常见", "方法", "为什么", "以及", "区别", "总结"]
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+
+def read_rss_bytes(pid):
+    """读取进程常驻内存（仅支持 Linux 的 /proc）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler:
+    """后台定时采样服务进程的内存"""
+
+    def __init__(self, pid, interval=0.5):
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self.samples = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = read_rss_bytes(self._pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self._interval)
+
+    def start(self):
+        if self._pid:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if not self.samples:
+            return {'start': None, 'peak': None, 'end': None}
+        return {'start': self.samples[0], 'peak': max(self.samples), 'end': self.samples[-1]}
+
+
+class VirtualUser:
+    """一个浏览器会话：记录最近渲染的控件，按浏览器的方式提交控件状态触发重跑"""
+
+    def __init__(self, index, ws_url, api_key, rng, run_timeout):
+        self.index = index
+        self._ws_url = ws_url
+        self._api_key = api_key
+        self._rng = rng
+        self._run_timeout = run_timeout
+        self._ws = None
+        self._widgets = {}          # (类型, 标签或key) -> (控件ID, 所属片段ID)
+        self._widget_states = {}    # 控件ID -> WidgetState
+        self.latencies = []
+        self.failed_replies = 0
+        self.exceptions = 0
+        self.timeouts = 0
+
+    async def connect(self):
+        self._ws = await websockets.connect(self._ws_url, subprotocols=["streamlit"], max_size=None)
+        await self._rerun()
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+
+    def _remember_element(self, delta):
+        element = delta.new_element
+        kind = element.WhichOneof('type')
+        if kind not in ('button', 'text_input', 'text_area'):
+            return
+        widget = getattr(element, kind)
+        name = widget.label
+        if kind == 'text_area' and widget.id.endswith(CHAT_INPUT_KEY):
+            name = CHAT_INPUT_KEY
+        self._widgets[(kind, name)] = (widget.id, delta.fragment_id)
+
+    def _find_widget(self, kind, name):
+        for (widget_kind, label), value in self._widgets.items():
+            if widget_kind == kind and name in label:
+                return value
+        return None, None
+
+    async def _rerun(self, trigger_id=None, fragment_id=""):
+        """发送一次重跑请求并等待脚本结束，返回本次运行中出现的提示文本"""
+        message = BackMsg()
+        client_state = message.rerun_script
+        client_state.query_string = ""
+        client_state.page_script_hash = ""
+        if fragment_id:
+            client_state.fragment_id = fragment_id
+        for state in self._widget_states.values():
+            client_state.widget_states.widgets.append(state)
+        if trigger_id:
+            trigger = client_state.widget_states.widgets.add()
+            trigger.id = trigger_id
+            trigger.trigger_value = True
+        await self._ws.send(message.SerializeToString())
+
+        alerts = []
+        while True:
+            raw = await asyncio.wait_for(self._ws.recv(), timeout=self._run_timeout)
+            msg = ForwardMsg.FromString(raw)
+            kind = msg.WhichOneof('type')
+            if kind == 'delta' and msg.delta.WhichOneof('type') == 'new_element':
+                element = msg.delta.new_element
+                element_kind = element.WhichOneof('type')
+                if element_kind == 'alert':
+                    alerts.append(element.alert.body)
+                elif element_kind == 'exception':
+                    self.exceptions += 1
+                self._remember_element(msg.delta)
+            elif kind == 'script_finished':
+                if msg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return alerts
+
+    def _set_string(self, widget_id, value):
+        message = BackMsg()
+        state = message.rerun_script.widget_states.widgets.add()
+        state.id = widget_id
+        state.string_value = value
+        self._widget_states[widget_id] = state
+
+    async def login(self):
+        widget_id, _ = self._find_widget('text_input', API_KEY_LABEL)
+        if widget_id is None:
+            raise RuntimeError("没有找到API密钥输入框")
+        self._set_string(widget_id, self._api_key)
+        await self._rerun()
+
+    def _random_message(self, mean_words):
+        count = max(2, int(self._rng.lognormvariate(0, 0.6) * mean_words))
+        return "".join(self._rng.choice(WORDS) for _ in range(count)) + "？"
+
+    async def send(self, mean_words):
+        input_id, _ = self._find_widget('text_area', CHAT_INPUT_KEY)
+        button_id, fragment_id = self._find_widget('button', SEND_BUTTON_LABEL)
+        if input_id is None or button_id is None:
+            raise RuntimeError("没有找到输入框或发送按钮")
+        self._set_string(input_id, self._random_message(mean_words))
+
+        start = time.perf_counter()
+        try:
+            alerts = await self._rerun(trigger_id=button_id, fragment_id=fragment_id)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        self.latencies.append(time.perf_counter() - start)
+        if any(FAILED_REPLY_MARK in alert for alert in alerts):
+            self.failed_replies += 1
+
+
+async def run_user(user, messages, think_time, mean_words, start_delay, errors):
+    await asyncio.sleep(start_delay)
+    try:
+        await user.connect()
+        await user.login()
+        for _ in range(messages):
+            # 思考时间服从指数分布，模拟真实用户阅读和输入的停顿
+            await asyncio.sleep(user._rng.expovariate(1 / think_time) if think_time > 0 else 0)
+            await user.send(mean_words)
+    except Exception as e:
+        errors.append(f"用户{user.index}: {type(e).__name__}: {e}")
+    finally:
+        await user.close()
+
+
+async def run_load(args, ws_url):
+    rng = random.Random(args.seed)
+    users = [VirtualUser(i, ws_url, args.api_key if args.shared_key else f"{args.api_key}-{i}",
+                         random.Random(rng.random()), args.run_timeout)
+             for i in range(args.users)]
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_user(user, args.messages, args.think_time, args.message_words,
+                 args.ramp_up * i / max(1, args.users), errors)
+        for i, user in enumerate(users)
+    ))
+    return users, errors, time.perf_counter() - start
+
+
+def wait_for_app(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("应用进程启动失败")
+        try:
+            if httpx.get(f"{base_url}/_stcore/health", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("等待应用启动超时")
+
+
+def start_app_process(port, mock_url, data_dir):
+    env = dict(os.environ,
+               MODEL_API_URL=mock_url,
+               APP_DATA_DIR=data_dir,
+               # 压测关注应用本身的并发能力，不让限流器排队
+               MODEL_RATE_LIMIT_RPM='1000000',
+               MODEL_RATE_LIMIT_TPM='1000000000')
+    command = [sys.executable, '-m', 'streamlit', 'run', APP_PATH,
+               '--server.headless', 'true', '--server.port', str(port),
+               '--browser.gatherUsageStats', 'false', '--global.developmentMode', 'false']
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def build_report(users, errors, elapsed, mock_stats, rss):
+    app_latencies = [latency for user in users for latency in user.latencies]
+    attempted = sum(len(user.latencies) + user.timeouts for user in users)
+    failed = sum(user.failed_replies for user in users)
+    return {
+        'users': len(users),
+        'elapsed_seconds': elapsed,
+        'messages_completed': len(app_latencies),
+        'throughput_per_second': len(app_latencies) / elapsed if elapsed else 0.0,
+        'app_latency': percentiles(app_latencies),
+        # 对话默认流式发送，探测请求为非流式，模型层只统计对话请求
+        'model_latency': percentiles(mock_stats['stream_durations']),
+        'model_requests': mock_stats['requests'],
+        'model_error_rate': mock_stats['errors'] / mock_stats['requests'] if mock_stats['requests'] else 0.0,
+        'failed_reply_rate': failed / attempted if attempted else 0.0,
+        'timeouts': sum(user.timeouts for user in users),
+        'script_exceptions': sum(user.exceptions for user in users),
+        'session_errors': errors,
+        'server_rss_bytes': rss,
+    }
+
+
+def print_report(report):
+    def seconds(value):
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    def megabytes(value):
+        return "-" if value is None else f"{value / (1 << 20):.1f} MB"
+
+    print(f"\n虚拟用户：{report['users']} · 总耗时 {report['elapsed_seconds']:.1f} 秒")
+    print(f"完成消息：{report['messages_completed']} · 吞吐量 {report['throughput_per_second']:.2f} 条/秒")
+    for name, title in (('app_latency', '应用层（点击到渲染完成）'), ('model_latency', '模型层（模拟服务处理对话）')):
+        values = report[name]
+        print(f"{title}：p50 {seconds(values['p50'])} · p95 {seconds(values['p95'])} · p99 {seconds(values['p99'])}")
+    print(f"模型请求 {report['model_requests']} 次 · 模型错误率 {report['model_error_rate']:.1%} · "
+          f"回复失败率 {report['failed_reply_rate']:.1%} · 超时 {report['timeouts']} · "
+          f"脚本异常 {report['script_exceptions']}")
+    rss = report['server_rss_bytes']
+    print(f"服务进程内存：开始 {megabytes(rss['start'])} · 峰值 {megabytes(rss['peak'])} · 结束 {megabytes(rss['end'])}")
+    for error in report['session_errors']:
+        print(f"  ⚠️ {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py 多用户并发压测")
+    parser.add_argument('--users', type=int, default=10, help="并发的虚拟用户数")
+    parser.add_argument('--messages', type=int, default=5, help="每个用户发送的消息数")
+    parser.add_argument('--think-time', type=float, default=3.0, help="两条消息之间的平均思考时间（秒）")
+    parser.add_argument('--message-words', type=int, default=12, help="每条消息的平均词数")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="所有用户在这段时间内陆续接入（秒）")
+    parser.add_argument('--run-timeout', type=float, default=120.0, help="单次重跑的最长等待（秒）")
+    parser.add_argument('--api-key', default='load-test-key')
+    parser.add_argument('--shared-key', action=argparse.BooleanOptionalAction, default=True,
+                        help="所有用户共用一个API密钥（团队共用的典型情况）")
+    parser.add_argument('--model-latency', type=float, default=0.5, help="模拟模型的首字延迟（秒）")
+    parser.add_argument('--chunks', type=int, default=20, help="模拟回复的流式分块数")
+    parser.add_argument('--chunk-interval', type=float, default=0.02, help="分块间隔（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="模拟模型返回错误的比例")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--mock-port', type=int, default=0, help="模拟服务端口，0 表示随机")
+    parser.add_argument('--app-port', type=int, default=8599, help="自动启动应用时使用的端口")
+    parser.add_argument('--app-url', help="压测已运行的应用，不再自动启动")
+    parser.add_argument('--app-pid', type=int, help="已运行应用的进程号，用于采样内存")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="把报告写入该JSON文件")
+    args = parser.parse_args()
+
+    mock = MockServer(MockConfig(args.model_latency, args.chunks, args.chunk_interval,
+                                 args.error_rate, args.error_status, seed=args.seed),
+                      port=args.mock_port).start()
+    process = None
+    if args.app_url:
+        base_url = args.app_url.rstrip('/')
+        pid = args.app_pid
+    else:
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        process = start_app_process(args.app_port, mock.url, tempfile.mkdtemp(prefix='app-load-'))
+        pid = process.pid
+    print(f"模拟模型服务：{mock.url}")
+
+    try:
+        wait_for_app(base_url, process)
+        sampler = RssSampler(pid).start()
+        ws_url = base_url.replace('http', 'ws', 1) + "/_stcore/stream"
+        users, errors, elapsed = asyncio.run(run_load(args, ws_url))
+        report = build_report(users, errors, elapsed, mock.stats.snapshot(), sampler.stop())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        mock.stop()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report['session_errors'] or report['script_exceptions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
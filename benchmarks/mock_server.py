@@ -0,0 +1,182 @@
+"""本地 OpenAI 兼容的模拟模型服务，供基准测试和压测使用
+
+可配置首字延迟、流式分块、分块间隔和错误注入；默认监听 127.0.0.1 的随机端口。
+
+    python benchmarks/mock_server.py --port 8765 --latency 0.2 --error-rate 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockConfig:
+    """模拟服务的行为参数，运行中可以直接修改"""
+
+    def __init__(self, latency=0.0, chunks=8, chunk_interval=0.0, error_rate=0.0,
+                 error_status=500, retry_after=None, seed=0):
+        self.latency = latency                  # 返回响应头之前的等待（秒）
+        self.chunks = chunks                    # 流式回复的分块数
+        self.chunk_interval = chunk_interval    # 分块之间的间隔（秒）
+        self.error_rate = error_rate            # 按此概率返回错误
+        self.error_status = error_status        # 注入错误时的状态码
+        self.retry_after = retry_after          # 注入 429 时附带的 Retry-After 秒数
+        self.random = random.Random(seed)
+
+
+class MockStats:
+    """统计请求数、错误数和服务端处理耗时（保留最近的单次耗时用于计算分位数）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.stream_requests = 0
+            self.errors = 0
+            self.server_time = 0.0
+            self.durations = deque(maxlen=100000)
+            self.stream_durations = deque(maxlen=100000)
+
+    def record(self, stream, error, duration):
+        with self._lock:
+            self.requests += 1
+            self.stream_requests += int(stream)
+            self.errors += int(error)
+            self.server_time += duration
+            self.durations.append(duration)
+            if stream:
+                self.stream_durations.append(duration)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'stream_requests': self.stream_requests,
+                'errors': self.errors,
+                'server_time': self.server_time,
+                'durations': list(self.durations),
+                'stream_durations': list(self.stream_durations),
+            }
+
+
+def make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, body, extra_headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+            self.wfile.flush()
+
+        def do_POST(self):
+            start = time.perf_counter()
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            stream = bool(body.get('stream'))
+            time.sleep(config.latency)
+
+            if config.error_rate and config.random.random() < config.error_rate:
+                headers = {}
+                if config.error_status == 429 and config.retry_after is not None:
+                    headers['Retry-After'] = str(config.retry_after)
+                self._send_json(config.error_status, {'error': {'message': 'injected error'}}, headers)
+                stats.record(stream, True, time.perf_counter() - start)
+                return
+
+            words = [f"片段{i} " for i in range(config.chunks)]
+            prompt = (body.get('messages') or [{}])[-1].get('content', '')
+            if not stream:
+                self._send_json(200, {
+                    'choices': [{'message': {'role': 'assistant', 'content': "".join(words)}}],
+                    'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(words)},
+                })
+                stats.record(stream, False, time.perf_counter() - start)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for word in words:
+                    chunk = {'choices': [{'delta': {'content': word}}]}
+                    self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    if config.chunk_interval:
+                        time.sleep(config.chunk_interval)
+                self._write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b'0\r\n\r\n')
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端取消（例如对冲请求落败）
+                pass
+            stats.record(stream, False, time.perf_counter() - start)
+
+    return Handler
+
+
+class MockServer:
+    """在后台线程运行的模拟服务"""
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self._server = ThreadingHTTPServer((host, port), make_handler(self.config, self.stats))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-model-server", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/chat/completions"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟模型服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--chunks', type=int, default=8)
+    parser.add_argument('--chunk-interval', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--retry-after', type=float, default=None)
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.chunks, args.chunk_interval, args.error_rate,
+                        args.error_status, args.retry_after)
+    server = MockServer(config, args.host, args.port).start()
+    print(f"模拟服务已启动：{server.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""离线基准测试：用本地模拟模型服务无界面地驱动 app.py，衡量历史规模对重跑耗时的影响
+
+每个场景通过 Streamlit 的 AppTest 运行整个应用，数据写入临时目录，不访问真实模型服务。
+结果与 benchmarks/baseline.json 比较，超出容差的指标会列出并以非零状态退出。
+
+    python benchmarks/run_benchmarks.py                    # 完整矩阵（10~10000条消息，1~1000个会话）
+    python benchmarks/run_benchmarks.py --quick            # 缩小规模，适合提交前快速检查
+    python benchmarks/run_benchmarks.py --update-baseline  # 用本次结果覆盖基线
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'app.py')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import MockConfig, MockServer  # noqa: E402
+
+HISTORY_SIZES = [10, 100, 1000, 10000]
+SESSION_COUNTS = [1, 10, 100, 1000]
+QUICK_HISTORY_SIZES = [10, 1000]
+QUICK_SESSION_COUNTS = [1, 100]
+MESSAGES_PER_SESSION = 10
+RERUN_REPEATS = 3
+SAMPLE_REPEATS = 5        # 切换、发送等单次操作重复采样的次数，取中位数
+ERROR_INJECTION_SENDS = 10
+MEMORY_MESSAGES = 10000
+APP_TIMEOUT_SECONDS = 300
+GUEST_ID_PARAM = 'uid'    # 与 app.GUEST_ID_PARAM 一致
+
+# 各类指标允许的回退幅度：新值 > 基线 * 比例 + 余量 时判定为回退
+TOLERANCES = {
+    'seconds': (1.5, 0.05),
+    'bytes': (1.1, 256),
+    'memory_bytes': (1.25, 1 << 20),
+    'count': (1.0, 0),
+    'retry_count': (1.25, 3),
+}
+
+# 取决于错误注入和重试时机的计数，每次运行会有波动
+RETRY_DEPENDENT_COUNTS = {'request_count', 'failed_reply_count'}
+
+
+def metric_kind(name):
+    if name.endswith('_bytes') and name.startswith('peak_memory'):
+        return 'memory_bytes'
+    if name.endswith('_bytes'):
+        return 'bytes'
+    if name in RETRY_DEPENDENT_COUNTS:
+        return 'retry_count'
+    if name.endswith('_count'):
+        return 'count'
+    return 'seconds'
+
+
+def generate_history(message_count, seed):
+    """生成交替的用户/助手消息，长度有一定随机性"""
+    rng = random.Random(seed)
+    messages = []
+    base_time = time.time() - message_count * 30
+    for i in range(message_count):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        length = rng.randint(20, 80) if role == 'user' else rng.randint(100, 600)
+        messages.append({
+            'role': role,
+            'content': "".join(rng.choice("基准测试消息内容abcdefg，。 ") for _ in range(length)),
+            'timestamp': base_time + i * 30,
+            'model': 'gpt-4o-mini',
+        })
+    return messages
+
+
+def load_app_module():
+    """以普通模块方式加载 app.py，用于向会话存储写入测试数据"""
+    spec = importlib.util.spec_from_file_location('benchmark_app', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def guest_id_for(api_key):
+    """每个场景固定的访客ID，使预先写入的数据与应用内的会话归属一致"""
+    return hashlib.md5(api_key.encode('utf-8')).hexdigest()
+
+
+def bench_owner(app, api_key):
+    return app.make_session_owner(api_key, f"guest:{guest_id_for(api_key)}")
+
+
+def seed_sessions(app, api_key, session_count, messages_per_session):
+    owner = bench_owner(app, api_key)
+    for i in range(session_count):
+        app.store_append_messages(owner, f"bench_{owner[:12]}_{i}",
+                                  generate_history(messages_per_session, seed=i),
+                                  f"基准会话 {i}", datetime.now())
+
+
+def timed(action):
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def check(at):
+    if at.exception:
+        raise RuntimeError(f"应用运行出错：{at.exception}")
+    return at
+
+
+def persisted_bytes(at):
+    """本次运行写入浏览器本地存储的脚本大小"""
+    return sum(len(element.value.encode('utf-8')) for element in at.markdown
+               if 'localStorage.setItem' in element.value)
+
+
+def start_app(api_key):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT_SECONDS)
+    at.query_params[GUEST_ID_PARAM] = guest_id_for(api_key)
+    check(at.run())
+    check(at.sidebar.text_input[0].input(api_key).run())
+    return at
+
+
+def click_button(at, label):
+    return next(b for b in at.button if label in b.label).click()
+
+
+def send_message(at, text):
+    at.text_area(key='chat_input').input(text)
+    return check(click_button(at, '发送').run())
+
+
+def median_rerun(at):
+    return statistics.median(timed(lambda: check(at.run())) for _ in range(RERUN_REPEATS))
+
+
+def median_cold_switch(api_key):
+    """每次新开一个应用实例并切换到第一个会话（不命中已加载的消息窗口），取中位数"""
+    samples = []
+    for _ in range(SAMPLE_REPEATS):
+        at = start_app(api_key)
+        samples.append(timed(lambda: check(click_button(at, '切换').run())))
+    return statistics.median(samples), at
+
+
+def median_send(at, server):
+    """重复发送消息，返回 (发送耗时中位数, 扣除模拟服务处理时间后的应用开销中位数)"""
+    send_times = []
+    overheads = []
+    for i in range(SAMPLE_REPEATS):
+        server.stats.reset()
+        send_time = timed(lambda i=i: send_message(at, f"基准测试问题{i}"))
+        send_times.append(send_time)
+        overheads.append(max(0.0, send_time - server.stats.snapshot()['server_time']))
+    return statistics.median(send_times), statistics.median(overheads)
+
+
+def peak_memory(action):
+    tracemalloc.start()
+    try:
+        action()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_history(app, server, message_count):
+    """单个会话包含 message_count 条消息：切换、整页重跑、发送一条消息"""
+    api_key = f"bench-history-{message_count}"
+    seed_sessions(app, api_key, 1, message_count)
+
+    switch_time, at = median_cold_switch(api_key)
+    switch_bytes = persisted_bytes(at)
+    rerun_time = median_rerun(at)
+
+    send_time, request_overhead = median_send(at, server)
+    send_bytes = persisted_bytes(at)
+
+    memory = peak_memory(lambda: check(at.run()))
+    return {
+        'switch_seconds': switch_time,
+        'rerun_seconds': rerun_time,
+        'send_seconds': send_time,
+        'request_overhead_seconds': request_overhead,
+        'switch_persist_bytes': switch_bytes,
+        'send_persist_bytes': send_bytes,
+        'peak_memory_bytes': memory,
+    }
+
+
+def bench_sessions(app, server, session_count):
+    """同一用户有 session_count 个会话：整页重跑（含历史面板）和切换会话"""
+    api_key = f"bench-sessions-{session_count}"
+    seed_sessions(app, api_key, session_count, MESSAGES_PER_SESSION)
+    rerun_time = median_rerun(start_app(api_key))
+    switch_time, at = median_cold_switch(api_key)
+    memory = peak_memory(lambda: check(at.run()))
+    return {
+        'rerun_seconds': rerun_time,
+        'switch_seconds': switch_time,
+        'switch_persist_bytes': persisted_bytes(at),
+        'peak_memory_bytes': memory,
+    }
+
+
+def retained_memory(build):
+    """build() 返回的对象常驻时占用的内存"""
+    tracemalloc.start()
+    try:
+        result = build()
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+
+def bench_message_memory(app):
+    """从存储加载 MEMORY_MESSAGES 条消息后的常驻内存：原先的字典表示与 ChatMessage 对比（均含token计数缓存）"""
+    owner = bench_owner(app, "bench-memory")
+    session_id = f"bench_{owner[:12]}_memory"
+    app.store_append_messages(owner, session_id, generate_history(MEMORY_MESSAGES, seed=0),
+                              "内存基准", datetime.now())
+    encoding_name = app.get_encoding_name('gpt-4o-mini')
+
+    def load_dicts():
+        conn = app.open_session_db()
+        try:
+            rows = conn.execute("SELECT id, role, content, model, timestamp FROM messages WHERE session_id = ? ORDER BY id",
+                                (session_id,)).fetchall()
+        finally:
+            conn.close()
+        return [{'id': row[0], 'role': row[1], 'content': row[2], 'model': row[3], 'timestamp': row[4],
+                 'token_counts': {encoding_name: 0}} for row in rows]
+
+    def load_compact():
+        messages, _ = app.store_load_messages(owner, session_id, limit=MEMORY_MESSAGES)
+        for msg in messages:
+            msg.token_cache = (encoding_name, 0)
+        return messages
+
+    dict_bytes, dicts = retained_memory(load_dicts)
+    compact_bytes, compact = retained_memory(load_compact)
+    if [app.ChatMessage.from_dict(d) for d in dicts] != compact:
+        raise RuntimeError("ChatMessage 与字典表示的内容不一致")
+    return {
+        'dict_message_bytes': dict_bytes,
+        'compact_message_bytes': compact_bytes,
+    }
+
+
+def bench_error_injection(server):
+    """模拟服务按比例返回 429，衡量重试带来的额外耗时和最终失败数"""
+    at = start_app("bench-errors")
+    server.config.error_rate = 0.3
+    server.config.error_status = 429
+    server.config.retry_after = 0
+    server.stats.reset()
+    try:
+        send_times = [timed(lambda i=i: send_message(at, f"注入错误的问题{i}"))
+                      for i in range(ERROR_INJECTION_SENDS)]
+    finally:
+        server.config.error_rate = 0.0
+    failures = sum(1 for msg in at.session_state['chat_messages']
+                   if msg['role'] == 'assistant' and msg['content'].startswith('❌'))
+    stats = server.stats.snapshot()
+    return {
+        'send_seconds': statistics.median(send_times),
+        'request_count': stats['requests'],
+        'failed_reply_count': failures,
+    }
+
+
+def run_all(quick, latency):
+    data_dir = tempfile.mkdtemp(prefix='app-bench-')
+    server = MockServer(MockConfig(latency=latency, chunks=8, chunk_interval=0.002, seed=42)).start()
+    os.environ.update({
+        'APP_DATA_DIR': data_dir,
+        'MODEL_API_URL': server.url,
+        # 基准测试只衡量应用本身，不让限流器排队
+        'MODEL_RATE_LIMIT_RPM': '1000000',
+        'MODEL_RATE_LIMIT_TPM': '1000000000',
+    })
+    app = load_app_module()
+
+    results = {}
+    try:
+        for message_count in (QUICK_HISTORY_SIZES if quick else HISTORY_SIZES):
+            print(f"· 历史消息 {message_count} 条", flush=True)
+            results[f"history_{message_count}"] = bench_history(app, server, message_count)
+        for session_count in (QUICK_SESSION_COUNTS if quick else SESSION_COUNTS):
+            print(f"· 会话 {session_count} 个", flush=True)
+            results[f"sessions_{session_count}"] = bench_sessions(app, server, session_count)
+        print(f"· 消息内存（{MEMORY_MESSAGES} 条）", flush=True)
+        results['message_memory'] = bench_message_memory(app)
+        print("· 错误注入", flush=True)
+        results['error_injection'] = bench_error_injection(server)
+    finally:
+        server.stop()
+    return results
+
+
+def format_value(name, value):
+    kind = metric_kind(name)
+    if kind == 'seconds':
+        return f"{value * 1000:.1f} ms"
+    if kind in ('bytes', 'memory_bytes'):
+        return f"{value / 1024:.1f} KB"
+    return str(value)
+
+
+def compare(results, baseline):
+    """返回超出容差的 (场景, 指标, 基线值, 本次值) 列表"""
+    regressions = []
+    for scenario, metrics in results.items():
+        for name, value in metrics.items():
+            base = baseline.get(scenario, {}).get(name)
+            if base is None:
+                continue
+            ratio, slack = TOLERANCES[metric_kind(name)]
+            if value > base * ratio + slack:
+                regressions.append((scenario, name, base, value))
+    return regressions
+
+
+def print_results(results, baseline):
+    for scenario, metrics in results.items():
+        print(f"\n[{scenario}]")
+        for name, value in metrics.items():
+            base = baseline.get(scenario, {}).get(name)
+            suffix = f"（基线 {format_value(name, base)}）" if base is not None else ""
+            print(f"  {name:<28}{format_value(name, value):>14}{suffix}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py 离线基准测试")
+    parser.add_argument('--quick', action='store_true', help="只运行缩小规模的矩阵")
+    parser.add_argument('--latency', type=float, default=0.05, help="模拟服务的首字延迟（秒）")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument('--update-baseline', action='store_true', help="用本次结果更新基线")
+    parser.add_argument('--output', help="把本次结果写入该JSON文件")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+
+    results = run_all(args.quick, args.latency)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.update_baseline:
+        merged = dict(baseline, **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'recorded_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'mock_latency': args.latency,
+                'results': merged,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已更新：{args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline)
+    if regressions:
+        print("\n❌ 性能回退：")
+        for scenario, name, base, value in regressions:
+            print(f"  {scenario}.{name}: {format_value(name, base)} → {format_value(name, value)}")
+        return 1
+    print("\n✅ 未发现性能回退" if baseline else "\n（没有基线，使用 --update-baseline 记录）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())